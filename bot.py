@@ -37,6 +37,7 @@ async def main():
         
     # 2. INITIALIZE DATABASE
     await db.setup_ttl_index()
+    await db.load_link_revocation()
 
     # 3. BUILD TELEGRAM APP
     app = ApplicationBuilder().token(secret.BOT_TOKEN).connection_pool_size(secret.WORKERS).build()
@@ -7,6 +7,10 @@ from telegram.constants import ParseMode
 import secret
 from database.db import db
 import script # To access and clear the SPAM_CACHE
+from filetolink.cache import chunk_cache
+from filetolink.disk_cache import disk_cache
+from filetolink.warmup import cancel_warmup
+from filetolink.container import reset_indexes
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +97,7 @@ async def run_ram_cleaner(update: Update, context, edit_msg=None):
     
     # 2. Clear Internal Bot Caches
     script.SPAM_CACHE.clear()
+    chunk_cache.clear()
     
     ram_after = get_ram_usage()
     freed = max(0, ram_before - ram_after)
@@ -101,7 +106,8 @@ async def run_ram_cleaner(update: Update, context, edit_msg=None):
         f"<b><u><blockquote>🚀 RAM OPTIMIZATION PROTOCOL</blockquote></u></b>\n\n"
         f"<i>\"Flushing the memory buffers...\"</i>\n\n"
         f"🧠 <b>Garbage Objects Destroyed:</b> <code>{collected}</code>\n"
-        f"🛡️ <b>Spam Cache:</b> <code>Wiped Clean</code>\n\n"
+        f"🛡️ <b>Spam Cache:</b> <code>Wiped Clean</code>\n"
+        f"🎞️ <b>Stream Chunk Cache:</b> <code>Wiped Clean</code>\n\n"
         f"📉 <b>RAM Before:</b> <code>{ram_before:.2f} MB</code>\n"
         f"📈 <b>RAM After:</b> <code>{ram_after:.2f} MB</code>\n"
         f"✅ <b>Total Memory Freed:</b> <code>{freed:.2f} MB</code>"
@@ -148,8 +154,13 @@ async def cleanup_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     elif data == "kill_execute":
         # Delete everything from the links collection
-        deleted = await db.links.delete_many({})
+        deleted = await db.delete_all_links()
         count = deleted.deleted_count
+        # Dead links free their cached segments right away
+        cancel_warmup()
+        reset_indexes()
+        chunk_cache.clear()  # Pinned indexes included
+        disk_cache.clear()
         text = (
             f"<b><u><blockquote>☠️ MASSACRE COMPLETE</blockquote></u></b>\n\n"
             f"<i>\"I am become Death, the destroyer of links.\"</i>\n\n"
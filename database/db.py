@@ -1,10 +1,74 @@
 import motor.motor_asyncio
 import datetime
 import logging
+import time
+from collections import OrderedDict
 import secret
 
 logger = logging.getLogger(__name__)
 
+class LinkCache:
+    """Bounded in-process TTL cache in front of get_link().
+    Entries never outlive the link's own expires_at, and misses are cached
+    briefly too so scanners hammering random hashes never reach Mongo."""
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()  # hash_id -> (doc or None, valid_until)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, hash_id):
+        """Returns (found, doc); doc is None for a cached miss."""
+        entry = self._data.get(hash_id)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._data[hash_id]
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(hash_id)
+        if entry[0] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, entry[0]
+
+    def put(self, hash_id, doc):
+        if self.max_entries <= 0:
+            return
+        ttl = self.negative_ttl if doc is None else min(self.ttl, seconds_left(doc))
+        if ttl <= 0:
+            return
+        self._data[hash_id] = (doc, time.monotonic() + ttl)
+        self._data.move_to_end(hash_id)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self, hash_id):
+        self._data.pop(hash_id, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
+
+def seconds_left(link):
+    """Seconds until a link document's expires_at (Mongo hands back naive UTC)."""
+    expires_at = link.get("expires_at")
+    if not expires_at:
+        return float("inf")
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return (expires_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
 class Database:
     def __init__(self, uri, database_name):
         self._client = motor.motor_asyncio.AsyncIOMotorClient(uri)
@@ -12,6 +76,8 @@ class Database:
         self.col = self.db.users
         self.settings = self.db.settings # Global Settings DB
         self.links = self.db.file_links  # 🔥 New File-to-Link Collection
+        self.link_cache = LinkCache(secret.LINK_CACHE_SIZE, secret.LINK_CACHE_TTL, secret.LINK_NEGATIVE_TTL)
+        self.links_revoked_before = None  # Signed tokens issued before this are dead (/kill)
         logger.info("✅ MongoDB Connected Successfully!")
 
     # ================= FILE TO LINK ENGINE (SELF DESTRUCT) =================
@@ -24,20 +90,63 @@ class Database:
             logger.error(f"TTL Index Error: {e}")
 
     # 🔥 UPDATED FOR 4GB MTPROTO: Added chat_id and message_id
-    async def save_link(self, hash_id, chat_id, message_id, file_name, size, expires_at):
-        """Saves the encrypted link to the database."""
+    async def save_link(self, hash_id, chat_id, message_id, file_name, size, expires_at, media=None, owner_id=None, premium=False):
+        """Saves the encrypted link to the database.
+        `media` is the stream descriptor (file_id, dc_id, file_size, mime_type...)
+        so the web server can serve bytes without a get_messages() call.
+        `premium` (owner's status at creation) gives the link's fetches priority."""
         await self.links.insert_one({
             "_id": hash_id, 
             "chat_id": chat_id, 
             "message_id": message_id,
             "file_name": file_name,
             "size": size,
+            "media": media,
+            "owner_id": owner_id,
+            "premium": premium,
             "expires_at": expires_at
         })
+        self.link_cache.invalidate(hash_id)  # Drop any cached "not found"
+
+    async def update_link_media(self, hash_id, media):
+        """Stores a refreshed descriptor (new file reference) on an existing link."""
+        await self.links.update_one({"_id": hash_id}, {"$set": {"media": media}})
 
     async def get_link(self, hash_id):
         """Retrieves link data if it hasn't expired yet."""
-        return await self.links.find_one({"_id": hash_id})
+        found, link = self.link_cache.get(hash_id)
+        if not found:
+            link = await self.links.find_one({"_id": hash_id})
+            self.link_cache.put(hash_id, link)
+        # The TTL monitor only runs every ~60s; don't serve links past their expiry
+        if link and seconds_left(link) <= 0:
+            return None
+        return link
+
+    async def delete_all_links(self):
+        """Wipes every link (used by /kill) and the in-process cache with it.
+        Signed tokens carry no database state, so they are revoked by moving
+        the issue-time cutoff forward."""
+        result = await self.links.delete_many({})
+        self.link_cache.clear()
+        # Whole seconds, like the issue time inside the tokens: a link made later in the same second survives
+        cutoff = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        await self.settings.update_one({"_id": "link_revocation"}, {"$set": {"before": cutoff}}, upsert=True)
+        self.links_revoked_before = cutoff
+        return result
+
+    async def load_link_revocation(self):
+        """Loads the signed-token cutoff into memory on startup."""
+        doc = await self.settings.find_one({"_id": "link_revocation"})
+        cutoff = doc.get("before") if doc else None
+        if cutoff is not None and cutoff.tzinfo is None:
+            cutoff = cutoff.replace(tzinfo=datetime.timezone.utc)  # Mongo hands back naive UTC
+        if cutoff is not None:
+            cutoff = cutoff.replace(microsecond=0)  # Cutoffs stored before whole-second rounding
+        self.links_revoked_before = cutoff
+
+    def is_link_revoked(self, issued_at):
+        return self.links_revoked_before is not None and issued_at < self.links_revoked_before
 
     # ================= USER SYSTEM =================
     def new_user(self, id, name, username):
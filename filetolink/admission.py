@@ -0,0 +1,121 @@
+import math
+import asyncio
+import logging
+from collections import Counter, deque
+from aiohttp import web
+import secret
+from filetolink.shaper import client_ip
+logger = logging.getLogger(__name__)
+# Routes that hold a TurboStreamer (and Telegram fetches) for their whole life
+HEAVY_PREFIXES = ("/stream/", "/dl/", "/remux/")
+class AdmissionControl:
+    """
+    Caps concurrent heavy responses globally, per client IP and per link.
+
+    A connection over a cap waits in a short FIFO queue for a slot; when
+    the queue is full, or the wait runs out, it gets a 503 with Retry-After
+    (IDM / aria2 / browsers all back off and retry on that) instead of
+    another streamer and another set of Telegram fetches.
+    """
+    def __init__(self, max_total, max_per_ip, max_per_link, queue_size, max_wait):
+        self.limits = {"total": max_total, "ip": max_per_ip, "link": max_per_link}
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = Counter()  # "total", ("ip", ip), ("link", hash) -> open connections
+        self._waiters = deque()  # (keys, future), FIFO
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = Counter()  # reason -> count
+
+    def _keys(self, ip, link):
+        return ("total", ("ip", ip), ("link", link))
+
+    def _fits(self, keys):
+        return all(self.active[key] < self.limits[key if key == "total" else key[0]] for key in keys)
+
+    def _take(self, keys):
+        for key in keys:
+            self.active[key] += 1
+        self.admitted += 1
+
+    async def acquire(self, ip, link):
+        """Slot keys once admitted, or None if the connection should get a 503."""
+        keys = self._keys(ip, link)
+        # Freed slots go to waiters as soon as they open, so any slot still free here is fair game
+        if self._fits(keys):
+            self._take(keys)
+            return keys
+        if len(self._waiters) >= self.queue_size:
+            self.rejected["queue_full"] += 1
+            return None
+        fut = asyncio.get_running_loop().create_future()
+        entry = (keys, fut)
+        self._waiters.append(entry)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.max_wait)
+            return keys
+        except asyncio.TimeoutError:
+            if fut.done():
+                return keys  # Granted on the last tick
+            self.rejected["timeout"] += 1
+            return None
+        except asyncio.CancelledError:
+            if fut.done():
+                self.release(keys)  # Granted just as the client went away
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+                self._waiters.remove(entry)
+
+    def release(self, keys):
+        for key in keys:
+            self.active[key] -= 1
+            if self.active[key] <= 0:
+                del self.active[key]
+        # 🚦 Hand freed slots out in arrival order, skipping waiters still over their own caps
+        for entry in list(self._waiters):
+            waiting_keys, fut = entry
+            if not fut.done() and self._fits(waiting_keys):
+                self._waiters.remove(entry)
+                self._take(waiting_keys)
+                fut.set_result(None)
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: roughly one queue's turnover."""
+        return max(1, math.ceil(self.max_wait * (1 + len(self._waiters) / max(1, self.limits["total"]))))
+
+    def stats(self):
+        return {
+            "active": self.active["total"],
+            "limits": dict(self.limits),
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+            "busiest_ips": sorted((n for key, n in self.active.items() if key[0] == "ip"), reverse=True)[:5],
+        }
+admission = AdmissionControl(
+    secret.MAX_STREAMS,
+    secret.MAX_STREAMS_PER_IP,
+    secret.MAX_STREAMS_PER_LINK,
+    secret.ADMISSION_QUEUE,
+    secret.ADMISSION_WAIT_SECONDS,
+)
+@web.middleware
+async def admission_middleware(request, handler):
+    # 🚦 Only streaming bodies count; HEAD probes, pages, playlists and subtitles pass straight through
+    if request.method == "HEAD" or not request.path.startswith(HEAVY_PREFIXES):
+        return await handler(request)
+    keys = await admission.acquire(client_ip(request), request.match_info.get("hash_id"))
+    if keys is None:
+        return web.Response(
+            text="❌ 503 - Too many connections, retry shortly",
+            status=503,
+            headers={"Retry-After": str(admission.retry_after())},
+        )
+    try:
+        return await handler(request)
+    finally:
+        admission.release(keys)
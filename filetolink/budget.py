@@ -0,0 +1,110 @@
+import math
+import asyncio
+import logging
+from collections import deque
+import secret
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+class StreamBudget:
+    """
+    Global memory budget for every TurboStreamer buffer in the process.
+
+    Workers reserve a chunk's worth of bytes before fetching from Telegram
+    and the streamer releases it once the chunk has been handed to the
+    client, so the total held in all buffers never exceeds STREAM_BUDGET_MB.
+    New streams are granted a worker count from the free budget, their fair
+    share of it, and the per-fetch throughput measured so far.
+    """
+    def __init__(self, max_bytes, max_workers, target_rate, chunk_size=CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers  # {"stream": n, "dl": n}
+        self.target_rate = target_rate  # bytes/s we try to give one stream
+        self.chunk_size = chunk_size
+        self.held = 0
+        self.active = 0
+        self._waiters = deque()  # (nbytes, future), FIFO
+        # Per-fetch throughput (EWMA, bytes/s); None until the first sample
+        self.fetch_rate = None
+        self.grants = 0
+        self.granted_workers = 0
+        self.waits = 0
+
+    # ================= ADMISSION =================
+    def grant(self, kind):
+        """Worker count for a new stream of `kind` ("stream" or "dl")."""
+        cap = self.max_workers.get(kind, 1)
+        # Every worker may hold one chunk in flight and one waiting in the buffer
+        share = (self.max_bytes - self.held) // (self.active + 1)
+        by_memory = share // (2 * self.chunk_size)
+        by_rate = cap
+        if self.fetch_rate:
+            by_rate = math.ceil(self.target_rate / self.fetch_rate)
+        workers = max(1, min(cap, by_memory, by_rate))
+        self.grants += 1
+        self.granted_workers += workers
+        return workers
+
+    def open(self):
+        self.active += 1
+
+    def close(self):
+        self.active -= 1
+
+    # ================= BYTE ACCOUNTING =================
+    async def reserve(self, nbytes, urgent=False):
+        """
+        Wait until `nbytes` fit in the budget. `urgent` reservations (the
+        chunk a client is blocked on) always pass, so no stream can deadlock.
+        """
+        if urgent or (not self._waiters and self.held + nbytes <= self.max_bytes):
+            self.held += nbytes
+            return
+        self.waits += 1
+        fut = asyncio.get_running_loop().create_future()
+        entry = (nbytes, fut)
+        self._waiters.append(entry)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(nbytes)
+            else:
+                self._waiters.remove(entry)
+            raise
+
+    def release(self, nbytes):
+        self.held -= nbytes
+        while self._waiters:
+            nbytes, fut = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            if self.held + nbytes > self.max_bytes:
+                break
+            self._waiters.popleft()
+            self.held += nbytes
+            fut.set_result(None)
+
+    def record_fetch(self, nbytes, seconds):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        self.fetch_rate = rate if self.fetch_rate is None else 0.8 * self.fetch_rate + 0.2 * rate
+
+    def stats(self):
+        return {
+            "max_bytes": self.max_bytes,
+            "held_bytes": self.held,
+            "active_streams": self.active,
+            "waiting_fetches": len(self._waiters),
+            "fetch_rate_bps": int(self.fetch_rate or 0),
+            "grants": self.grants,
+            "avg_workers": round(self.granted_workers / self.grants, 2) if self.grants else 0,
+            "budget_waits": self.waits,
+        }
+# 🧠 One budget for the whole web tier
+stream_budget = StreamBudget(
+    secret.STREAM_BUDGET_MB * 1024 * 1024,
+    {"stream": secret.STREAM_MAX_WORKERS, "dl": secret.DL_MAX_WORKERS},
+    secret.STREAM_TARGET_MBPS * 1024 * 1024,
+)
@@ -0,0 +1,10 @@
+import logging
+logger = logging.getLogger(__name__)
+# Chunks travel through the cache, the disk writer and the response as the
+# received bytes or memoryviews trimmed out of them, never as copies.
+def base_of(data):
+    """The object a chunk's memory belongs to (itself unless it is a view)."""
+    return data.obj if isinstance(data, memoryview) else data
+def footprint(data):
+    """Bytes a chunk keeps alive: a view pins its whole underlying buffer."""
+    return len(base_of(data))
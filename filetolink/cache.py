@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import secret
+from filetolink.buffers import footprint
+logger = logging.getLogger(__name__)
+class ChunkCache:
+    """
+    Process-wide LRU cache of downloaded chunks with a hard byte budget.
+
+    Keys are (chat_id, message_id, chunk_index), so every viewer of the same
+    file shares the same chunks no matter which link or endpoint they used.
+    """
+    def __init__(self, max_bytes, pin_max_bytes=0):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.size = 0
+        # Pinned chunks (container indexes) live outside the LRU until their deadline
+        self.pin_max_bytes = pin_max_bytes
+        self._pinned = {}  # key -> (data, monotonic deadline)
+        self.pinned_size = 0
+        # Counters exposed through /api/stats so the budget can be sized
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        pinned = self._pinned.get(key)
+        if pinned is not None:
+            if pinned[1] > time.monotonic():
+                self.hits += 1
+                return pinned[0]
+            self._unpin(key)
+        data = self._data.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        # Never let a single chunk blow the whole budget
+        if footprint(data) > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.size -= footprint(old)
+        self._data[key] = data
+        self.size += footprint(data)
+        if self.size > self.max_bytes:
+            self._expire_pins()  # Memory is tight: drop index pins past their deadline too
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._data)))
+            self.evictions += 1
+
+    def pin(self, key, data, ttl):
+        """Keep a chunk for `ttl` seconds regardless of LRU pressure. False if over the pin budget."""
+        self._expire_pins()
+        deadline = time.monotonic() + ttl
+        entry = self._pinned.get(key)
+        if entry is not None:
+            self._pinned[key] = (entry[0], max(entry[1], deadline))
+            return True
+        if self.pinned_size + footprint(data) > self.pin_max_bytes:
+            return False
+        self._pinned[key] = (data, deadline)
+        self.pinned_size += footprint(data)
+        return True
+
+    def _expire_pins(self):
+        now = time.monotonic()
+        for key in [k for k, (_, deadline) in self._pinned.items() if deadline <= now]:
+            self._unpin(key)
+
+    def _unpin(self, key):
+        data, _ = self._pinned.pop(key)
+        self.pinned_size -= footprint(data)
+
+    def _evict(self, key):
+        self.size -= footprint(self._data.pop(key))
+
+    def clear(self):
+        for key in list(self._data):
+            self._evict(key)
+        self.size = 0
+        self._pinned.clear()
+        self.pinned_size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "pinned_chunks": len(self._pinned),
+            "pinned_bytes": self.pinned_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+class SingleFlight:
+    """
+    In-flight fetch table: while a chunk is being pulled from Telegram, any
+    other request for the same key awaits that fetch instead of starting its
+    own. The fetch runs as its own task, so the first requester disconnecting
+    does not fail everyone else waiting on it; once the last one is gone the
+    fetch is cancelled rather than left pulling bytes nobody will read.
+    """
+    def __init__(self):
+        self._inflight = {}
+        self._waiters = {}  # key -> requesters still awaiting the fetch
+        self.fetches = 0
+        self.coalesced = 0  # Telegram calls saved
+        self.abandoned = 0  # Fetches cancelled because every requester left
+
+    def start(self, key, fetch):
+        """The in-flight task for `key`, starting `fetch()` right now if there is none."""
+        task = self._inflight.get(key)
+        if task is None:
+            self.fetches += 1
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        return task
+
+    async def run(self, key, fetch):
+        return await self.wait(key, self.start(key, fetch))
+
+    async def wait(self, key, task):
+        """Await a task from start(); it is cancelled if every waiter leaves first."""
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                task.cancel()
+                if self._inflight.get(key) is task:
+                    del self._inflight[key]  # A later requester starts a fresh fetch
+                self.abandoned += 1
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def pending(self, key):
+        """True while a fetch for `key` is in flight."""
+        return key in self._inflight
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Mark retrieved even if every waiter left
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "fetches": self.fetches,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+# 🔥 One cache (and one in-flight table) for the whole web tier
+chunk_cache = ChunkCache(secret.CHUNK_CACHE_MB * 1024 * 1024, secret.PIN_CACHE_MB * 1024 * 1024)
+inflight = SingleFlight()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId
+import secret
+from filetolink.fetcher import get_fetcher
+from filetolink.media import media_of
+logger = logging.getLogger(__name__)
+FAILURE_LIMIT = 3  # Consecutive connection errors before a client is drained
+FAILURE_COOLDOWN = 30  # ...and for how long (seconds)
+class _Member:
+    """One MTProto client in the pool plus its health counters."""
+    def __init__(self, client, primary):
+        self.client = client
+        self.primary = primary
+        self.fetcher = get_fetcher(client)
+        self.ready = primary  # The bot's own client is started by the web server
+        self.inflight = 0
+        self.down_until = 0.0
+        self.failures = 0
+        self.fetches = 0
+        self.floods = 0
+        self._file_ids = OrderedDict()  # media key -> this bot's FileId
+
+    async def file_id(self, media):
+        """
+        File ids are bot-specific, so helpers look the file up once through
+        the mirror copy in STREAM_CHANNEL_ID and remember their own id.
+        """
+        if self.primary:
+            return media.file_id
+        file_id = self._file_ids.get(media.key)
+        if file_id is None:
+            mirror = media.mirror
+            message = await self.client.get_messages(mirror["chat_id"], mirror["message_id"])
+            found = media_of(message)
+            if not found:
+                raise ValueError("Mirrored media not found")
+            file_id = self._file_ids[media.key] = FileId.decode(found.file_id)
+            if len(self._file_ids) > 1024:
+                self._file_ids.popitem(last=False)
+        return file_id
+
+    def forget(self, key):
+        self._file_ids.pop(key, None)
+class ClientPool:
+    """
+    The bot's own Pyrogram client plus helper bots from HELPER_BOT_TOKENS.
+
+    Every chunk fetch leases the least loaded client that is not drained.
+    FloodWaits and repeated connection errors drain a client until it
+    recovers, and while helpers can carry the load the bot's own client
+    takes at most PRIMARY_MAX_FETCHES fetches so bot work is never starved.
+    """
+    def __init__(self, primary, helper_tokens, primary_cap):
+        self.primary_cap = max(1, primary_cap)
+        self.members = [_Member(primary, True)]
+        for i, token in enumerate(helper_tokens):
+            helper = Client(
+                f"titanium_helper_{i}",
+                api_id=secret.API_ID,
+                api_hash=secret.API_HASH,
+                bot_token=token,
+                in_memory=True,
+                no_updates=True,
+                sleep_threshold=0  # Surface FloodWaits so the pool can drain instead of sleeping
+            )
+            self.members.append(_Member(helper, False))
+
+    async def start(self, dc_ids=()):
+        """Log the helpers in, then pre-warm every client's media sessions."""
+        for member in self.members:
+            if not member.primary:
+                try:
+                    await member.client.start()
+                    member.ready = True
+                except Exception as e:
+                    logger.warning(f"Helper client {member.client.name} failed to start: {e}")
+                    continue
+            await member.fetcher.pool.prewarm(dc_ids)
+        logger.info(f"🤝 Client pool ready: {sum(m.ready for m in self.members)}/{len(self.members)} clients")
+
+    async def stop(self):
+        for member in self.members:
+            await member.fetcher.close()
+            if not member.primary and member.client.is_connected:
+                try:
+                    await member.client.stop()
+                except Exception:
+                    pass
+
+    def _pick(self, media):
+        now = asyncio.get_running_loop().time()
+        # Helpers can only serve files mirrored into the shared channel
+        members = [m for m in self.members if m.ready and (m.primary or media.mirror)]
+        healthy = [m for m in members if m.down_until <= now]
+        if not healthy:
+            return None, min(m.down_until for m in members) - now
+        helpers_up = any(not m.primary for m in healthy)
+        candidates = [m for m in healthy if not (m.primary and helpers_up and m.inflight >= self.primary_cap)]
+        return min(candidates, key=lambda m: m.inflight), 0
+
+    def _drain(self, member, seconds):
+        member.down_until = max(member.down_until, asyncio.get_running_loop().time() + seconds)
+        logger.warning(f"🚦 Client {member.client.name} drained for {seconds:.0f}s")
+
+    @asynccontextmanager
+    async def lease(self, media):
+        while True:
+            member, wait = self._pick(media)
+            if member is not None:
+                break
+            # Every client is throttled: sit out the shortest FloodWait
+            await asyncio.sleep(wait)
+        member.inflight += 1
+        member.fetches += 1
+        try:
+            yield member
+        except FloodWait as e:
+            member.floods += 1
+            self._drain(member, e.value)
+            raise
+        except (OSError, TimeoutError):
+            member.failures += 1
+            if member.failures >= FAILURE_LIMIT:
+                member.failures = 0
+                self._drain(member, FAILURE_COOLDOWN)
+            raise
+        else:
+            member.failures = 0
+        finally:
+            member.inflight -= 1
+
+    def stats(self):
+        now = asyncio.get_event_loop().time()
+        return {
+            m.client.name: {
+                "primary": m.primary,
+                "ready": m.ready,
+                "inflight": m.inflight,
+                "fetches": m.fetches,
+                "floods": m.floods,
+                "drained_for": max(0, round(m.down_until - now, 1)),
+                "sessions": m.fetcher.pool.stats(),
+            }
+            for m in self.members
+        }
+_pools = {}
+def get_client_pool(client):
+    """One pool per primary client (helpers come from HELPER_BOT_TOKENS)."""
+    pool = _pools.get(client.name)
+    if pool is None:
+        pool = _pools[client.name] = ClientPool(client, secret.HELPER_BOT_TOKENS, secret.PRIMARY_MAX_FETCHES)
+    return pool
@@ -0,0 +1,442 @@
+import asyncio
+import logging
+from collections import OrderedDict
+import secret
+from database.db import seconds_left
+from filetolink.cache import chunk_cache
+from filetolink.fast import TurboStreamer
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+MAX_ELEMENTS = 64  # Top-level boxes / elements walked before giving up
+# ISO-BMFF top-level boxes that players need before (or to) seek
+MP4_INDEX_BOXES = {b"moov", b"sidx", b"mfra"}
+MP4_TOP_LEVEL = {b"ftyp", b"styp", b"moov", b"mdat", b"free", b"skip", b"wide", b"sidx", b"moof", b"pdin", b"uuid"}
+# EBML (Matroska / WebM) element ids, marker bits included
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_CUES = 0x1C53BB6B
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_CLUSTER = 0x1F43B675
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TIME = 0xB3
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_CLUSTER_POSITION = 0xF1
+MKV_CUE_TRACK = 0xF7
+MKV_CUE_RELATIVE_POSITION = 0xF0
+MKV_CUE_DURATION = 0xB2
+def container_of(head):
+    """"mp4", "mkv" or None, sniffed from the first bytes of a file."""
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "mkv"
+    if len(head) >= 8 and head[4:8] in MP4_TOP_LEVEL:
+        return "mp4"
+    return None
+# ================= ISO-BMFF =================
+def box_header(buf, pos=0):
+    """(box_type, header_len, box_size) of the box at `pos`; size 0 = to EOF."""
+    size = int.from_bytes(buf[pos:pos + 4], "big")
+    box_type = bytes(buf[pos + 4:pos + 8])
+    if size == 1:
+        return box_type, 16, int.from_bytes(buf[pos + 8:pos + 16], "big")
+    return box_type, 8, size
+async def mp4_index(read, file_size):
+    """Byte ranges of the moov / sidx / mfra boxes, walking top-level boxes."""
+    ranges = []
+    pos = 0
+    for _ in range(MAX_ELEMENTS):
+        if pos + 8 > file_size:
+            break
+        header = await read(pos, 16)
+        if len(header) < 8:
+            break
+        box_type, header_len, size = box_header(header)
+        if size == 0:
+            size = file_size - pos
+        if size < header_len:
+            break  # Corrupt or not ISO-BMFF after all
+        if box_type in MP4_INDEX_BOXES:
+            ranges.append((pos, min(pos + size, file_size) - 1))
+        pos += size
+    if pos < file_size and file_size >= 16:
+        # Walk gave up among the moof/mdat pairs: an mfra announces itself in the trailing mfro
+        tail = await read(file_size - 16, 16)
+        mfra_size = int.from_bytes(tail[12:16], "big")
+        if bytes(tail[4:8]) == b"mfro" and 16 <= mfra_size <= file_size:
+            ranges.append((file_size - mfra_size, file_size - 1))
+    return ranges
+def iter_boxes(buf, start=0, end=None):
+    """(type, payload_start, box_end) for each box in buf[start:end]."""
+    end = len(buf) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        box_type, header_len, size = box_header(buf, pos)
+        if size == 0:
+            size = end - pos
+        if size < header_len:
+            return
+        yield box_type, pos + header_len, min(pos + size, end)
+        pos += size
+def find_box(buf, path, start=0, end=None):
+    """Payload (start, end) of the first box along `path`, e.g. [b"mdia", b"mdhd"]."""
+    for box_type, payload, box_end in iter_boxes(buf, start, end):
+        if box_type == path[0]:
+            return (payload, box_end) if len(path) == 1 else find_box(buf, path[1:], payload, box_end)
+    return None
+def _uint(buf, pos, size):
+    return int.from_bytes(buf[pos:pos + size], "big")
+def _versioned(buf, payload, v0_offset, v1_offset, v1_size=8):
+    """Field whose offset / width depends on the full-box version byte."""
+    if buf[payload] == 1:
+        return _uint(buf, payload + v1_offset, v1_size)
+    return _uint(buf, payload + v0_offset, 4)
+def parse_moov(moov):
+    """Movie timescale / duration, fragmentation and the main track's id and timescale."""
+    info = {"fragmented": find_box(moov, [b"moov", b"mvex"]) is not None}
+    mvhd = find_box(moov, [b"moov", b"mvhd"])
+    info["timescale"] = _versioned(moov, mvhd[0], 12, 20, 4) if mvhd else 0
+    info["duration"] = _versioned(moov, mvhd[0], 16, 24) if mvhd else 0
+    mehd = find_box(moov, [b"moov", b"mvex", b"mehd"])
+    if mehd:
+        info["duration"] = _versioned(moov, mehd[0], 4, 4)
+    body = find_box(moov, [b"moov"])
+    tracks = []
+    for box_type, payload, box_end in iter_boxes(moov, *body):
+        if box_type != b"trak":
+            continue
+        tkhd = find_box(moov, [b"tkhd"], payload, box_end)
+        hdlr = find_box(moov, [b"mdia", b"hdlr"], payload, box_end)
+        mdhd = find_box(moov, [b"mdia", b"mdhd"], payload, box_end)
+        if tkhd and hdlr and mdhd:
+            tracks.append({
+                "id": _versioned(moov, tkhd[0], 12, 20, 4),
+                "handler": bytes(moov[hdlr[0] + 8:hdlr[0] + 12]),
+                "timescale": _versioned(moov, mdhd[0], 12, 20, 4),
+                "stbl": find_box(moov, [b"mdia", b"minf", b"stbl"], payload, box_end),
+            })
+    # Segments are cut on the video track's keyframes (audio-only: first track)
+    info["track"] = next((t for t in tracks if t["handler"] == b"vide"), tracks[0] if tracks else None)
+    return info
+def sidx_segments(sidx, sidx_offset):
+    """[(start, end, seconds)] from a single-level sidx box found at `sidx_offset`."""
+    payload, box_end = find_box(sidx, [b"sidx"])
+    version = sidx[payload]
+    timescale = _uint(sidx, payload + 8, 4)
+    pos = payload + (20 if version == 0 else 28)
+    first_offset = _uint(sidx, pos - (4 if version == 0 else 8), 4 if version == 0 else 8)
+    count = _uint(sidx, pos + 2, 2)
+    pos += 4
+    offset = sidx_offset + box_end + first_offset
+    segments = []
+    for _ in range(count):
+        ref = _uint(sidx, pos, 4)
+        if ref >> 31:
+            return None  # Hierarchical sidx: points at more sidx boxes
+        size = ref & 0x7FFFFFFF
+        duration = _uint(sidx, pos + 4, 4)
+        segments.append((offset, offset + size - 1, duration / timescale))
+        offset += size
+        pos += 12
+    return segments
+def tfra_segments(mfra, mfra_offset, track, total_seconds):
+    """[(start, end, seconds)] between the moofs listed in the track's tfra."""
+    body = find_box(mfra, [b"mfra"])
+    for box_type, payload, box_end in iter_boxes(mfra, *body):
+        if box_type != b"tfra" or _uint(mfra, payload + 4, 4) != track["id"]:
+            continue
+        version = mfra[payload]
+        sizes = _uint(mfra, payload + 8, 4)
+        skip = ((sizes >> 4) & 3) + ((sizes >> 2) & 3) + (sizes & 3) + 3
+        field = 8 if version == 1 else 4
+        pos = payload + 16
+        points = {}
+        for _ in range(_uint(mfra, payload + 12, 4)):
+            time, moof = _uint(mfra, pos, field), _uint(mfra, pos + field, field)
+            points.setdefault(moof, time)  # First sync sample per fragment
+            pos += 2 * field + skip
+        ordered = sorted(points.items())
+        segments = []
+        for i, (moof, time) in enumerate(ordered):
+            if i + 1 < len(ordered):
+                end, seconds = ordered[i + 1][0] - 1, (ordered[i + 1][1] - time) / track["timescale"]
+            else:
+                end = mfra_offset - 1
+                seconds = max(total_seconds - time / track["timescale"], 0.001)
+            segments.append((moof, end, seconds))
+        return segments
+    return None
+def fragment_segments(boxes, info):
+    """Fragments of a fragmented MP4 from its sidx (or mfra); `boxes` maps type -> (offset, bytes)."""
+    segments = None
+    if b"sidx" in boxes:
+        segments = sidx_segments(boxes[b"sidx"][1], boxes[b"sidx"][0])
+    if not segments and b"mfra" in boxes and info["track"]:
+        total = info["duration"] / info["timescale"] if info["timescale"] else 0
+        segments = tfra_segments(boxes[b"mfra"][1], boxes[b"mfra"][0], info["track"], total)
+    return segments
+def sample_table_keyframes(moov, track):
+    """[(seconds, offset)] of each sync sample of a plain MP4 track, from its stbl."""
+    if not track["stbl"] or not track["timescale"]:
+        return []
+    start, end = track["stbl"]
+    tables = {box_type: payload for box_type, payload, _ in iter_boxes(moov, start, end)}
+    if b"stts" not in tables or b"stsc" not in tables or b"stsz" not in tables:
+        return []
+    def entries(box_type, width, fields, header=8):
+        payload = tables[box_type]
+        count = _uint(moov, payload + header - 4, 4)
+        pos = payload + header
+        for _ in range(count):
+            yield tuple(_uint(moov, pos + i * width, width) for i in range(fields))
+            pos += width * fields
+    if b"co64" in tables:
+        chunk_offsets = [o for o, in entries(b"co64", 8, 1)]
+    elif b"stco" in tables:
+        chunk_offsets = [o for o, in entries(b"stco", 4, 1)]
+    else:
+        return []
+    # No stss means every sample is a sync sample (audio): one point per chunk is enough
+    sync = {n for n, in entries(b"stss", 4, 1)} if b"stss" in tables else None
+    uniform = _uint(moov, tables[b"stsz"] + 4, 4)
+    sizes = None if uniform else [s for s, in entries(b"stsz", 4, 1, header=12)]
+    durations = ((count, delta) for count, delta in entries(b"stts", 4, 2))
+    stsc = list(entries(b"stsc", 4, 3))
+    left, delta, dts = 0, 0, 0
+    sample, run = 1, 0
+    points = []
+    for chunk, chunk_offset in enumerate(chunk_offsets, 1):
+        while run + 1 < len(stsc) and stsc[run + 1][0] <= chunk:
+            run += 1
+        per_chunk = stsc[run][1] if stsc else 0
+        offset = chunk_offset
+        for j in range(per_chunk):
+            if (sync is None and j == 0) or (sync is not None and sample in sync):
+                points.append((dts / track["timescale"], offset))
+            while left == 0:
+                left, delta = next(durations, (1 << 62, 0))
+            left -= 1
+            dts += delta
+            offset += uniform or (sizes[sample - 1] if sample <= len(sizes) else 0)
+            sample += 1
+    points.sort()
+    return points
+# ================= EBML =================
+def read_vint(buf, pos, keep_marker=False):
+    """(value, length) of the EBML variable-size integer at `pos`."""
+    first = buf[pos]
+    length = 9 - first.bit_length() if first else 0
+    if not 1 <= length <= 8 or pos + length > len(buf):
+        raise ValueError("Bad EBML vint")
+    value = first if keep_marker else first & (0xFF >> length)
+    for i in range(1, length):
+        value = (value << 8) | buf[pos + i]
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = -1  # Unknown size
+    return value, length
+def element_header(buf, pos=0):
+    """(element_id, header_len, data_size) of the element at `pos`."""
+    element_id, id_len = read_vint(buf, pos, keep_marker=True)
+    size, size_len = read_vint(buf, pos + id_len)
+    return element_id, id_len + size_len, size
+def iter_elements(buf, start, end):
+    pos = start
+    while pos < end:
+        element_id, header_len, size = element_header(buf, pos)
+        if size < 0:
+            return
+        yield element_id, pos + header_len, size
+        pos += header_len + size
+async def mkv_index(read, file_size):
+    """Byte range of the Cues element, found through the SeekHead (or by walking)."""
+    head = await read(0, 64 * 1024)
+    element_id, header_len, size = element_header(head)
+    if element_id != EBML_HEADER:
+        return []
+    pos = header_len + size
+    element_id, header_len, segment_size = element_header(head, pos)
+    if element_id != MKV_SEGMENT:
+        return []
+    segment = pos + header_len
+    segment_end = file_size if segment_size < 0 else min(file_size, segment + segment_size)
+    cues_at = None
+    pos = segment
+    for _ in range(MAX_ELEMENTS):
+        if pos + 12 > segment_end:
+            break
+        header = await read(pos, 12)
+        element_id, header_len, size = element_header(header)
+        if element_id == MKV_CUES:
+            cues_at = pos
+            break
+        if element_id == MKV_SEEK_HEAD and cues_at is None:
+            body = await read(pos + header_len, size)
+            for seek_id, seek_pos, seek_size in iter_elements(body, 0, len(body)):
+                if seek_id != MKV_SEEK:
+                    continue
+                target, offset = None, None
+                for child_id, child_pos, child_size in iter_elements(body, seek_pos, seek_pos + seek_size):
+                    value = body[child_pos:child_pos + child_size]
+                    if child_id == MKV_SEEK_ID:
+                        target = int.from_bytes(value, "big")
+                    elif child_id == MKV_SEEK_POSITION:
+                        offset = int.from_bytes(value, "big")
+                if target == MKV_CUES and offset is not None:
+                    cues_at = segment + offset
+            if cues_at is not None:
+                break
+        if size < 0:
+            break  # Unknown-size element (live stream cluster): can't skip it
+        pos += header_len + size
+    if cues_at is None:
+        return []
+    header = await read(cues_at, 12)
+    element_id, header_len, size = element_header(header)
+    if element_id != MKV_CUES or size < 0:
+        return []
+    return [(cues_at, min(cues_at + header_len + size, file_size) - 1)]
+async def find_index(read, file_size):
+    """Index byte ranges of an MP4 / MKV file; [] for anything else."""
+    kind = container_of(await read(0, 16))
+    try:
+        if kind == "mp4":
+            return await mp4_index(read, file_size)
+        if kind == "mkv":
+            return await mkv_index(read, file_size)
+    except (ValueError, IndexError) as e:
+        logger.debug(f"Container parse failed: {e}")
+    return []
+async def mkv_segment_info(read):
+    """(segment data start, timecode scale in ns) from the head of an MKV."""
+    head = await read(0, 64 * 1024)
+    element_id, header_len, size = element_header(head)
+    pos = header_len + size
+    element_id, header_len, _ = element_header(head, pos)
+    if element_id != MKV_SEGMENT:
+        raise ValueError("No Segment element")
+    segment = pos + header_len
+    try:
+        for element_id, data, size in iter_elements(head, segment, len(head)):
+            if element_id == MKV_CLUSTER:
+                break
+            if element_id == MKV_INFO:
+                for child_id, child, child_size in iter_elements(head, data, data + size):
+                    if child_id == MKV_TIMECODE_SCALE:
+                        return segment, int.from_bytes(head[child:child + child_size], "big")
+                break
+    except (ValueError, IndexError):
+        pass  # Ran off the end of the head buffer
+    return segment, 1000000
+def cue_points(cues, segment, timecode_scale):
+    """[(seconds, offset)] of the clusters listed in a Cues element."""
+    _, header_len, size = element_header(cues)
+    points = []
+    for element_id, data, size in iter_elements(cues, header_len, min(len(cues), header_len + size)):
+        if element_id != MKV_CUE_POINT:
+            continue
+        time, cluster = None, None
+        for child_id, child, child_size in iter_elements(cues, data, data + size):
+            if child_id == MKV_CUE_TIME:
+                time = int.from_bytes(cues[child:child + child_size], "big")
+            elif child_id == MKV_CUE_TRACK_POSITIONS and cluster is None:
+                for pos_id, value, value_size in iter_elements(cues, child, child + child_size):
+                    if pos_id == MKV_CUE_CLUSTER_POSITION:
+                        cluster = int.from_bytes(cues[value:value + value_size], "big")
+        if time is not None and cluster is not None:
+            points.append((time * timecode_scale / 1e9, segment + cluster))
+    points.sort()
+    return points
+def track_cues(cues, segment, track):
+    """
+    [(timecode, cluster offset, relative position, duration)] of one track's
+    CuePoints, in raw timecodes; relative position / duration are None when
+    the muxer didn't write them (mkvmerge does for subtitle tracks).
+    """
+    _, header_len, size = element_header(cues)
+    entries = []
+    for element_id, data, size in iter_elements(cues, header_len, min(len(cues), header_len + size)):
+        if element_id != MKV_CUE_POINT:
+            continue
+        time, positions = None, []
+        for child_id, child, child_size in iter_elements(cues, data, data + size):
+            if child_id == MKV_CUE_TIME:
+                time = int.from_bytes(cues[child:child + child_size], "big")
+            elif child_id == MKV_CUE_TRACK_POSITIONS:
+                fields = {
+                    pos_id: int.from_bytes(cues[value:value + value_size], "big")
+                    for pos_id, value, value_size in iter_elements(cues, child, child + child_size)
+                }
+                positions.append(fields)
+        for fields in positions:
+            if time is not None and fields.get(MKV_CUE_TRACK) == track and MKV_CUE_CLUSTER_POSITION in fields:
+                entries.append((
+                    time,
+                    segment + fields[MKV_CUE_CLUSTER_POSITION],
+                    fields.get(MKV_CUE_RELATIVE_POSITION),
+                    fields.get(MKV_CUE_DURATION),
+                ))
+    entries.sort()
+    return entries
+# ================= PINNING =================
+_indexes = OrderedDict()  # media key -> index byte ranges
+_tasks = {}
+_reset_hooks = []  # Caches built from the indexes (HLS plans, seek points, subtitles)
+def on_index_reset(hook):
+    """Have reset_indexes() call `hook()` too, for caches derived from the indexes."""
+    _reset_hooks.append(hook)
+def index_ranges(key):
+    """Index ranges found for a file so far, or None if not analysed yet."""
+    return _indexes.get(key)
+def reset_indexes():
+    for task in _tasks.values():
+        task.cancel()
+    _indexes.clear()
+    for hook in _reset_hooks:
+        hook()
+async def pin_index(client, media, ttl, priority=None):
+    """
+    Locate the file's container index and pin the chunks holding it in the
+    chunk cache for `ttl` seconds (the life of the link), so player startup
+    and every later seek read it from RAM.
+    """
+    if not media.file_size or ttl <= 0:
+        return []
+    streamer = TurboStreamer(client, media, 0, media.file_size - 1)
+    ranges = _indexes.get(media.key)
+    if ranges is None:
+        # Header probes are peeks (just the aligned parts); only the index chunks themselves are cached below
+        ranges = await find_index(lambda offset, length: streamer.peek(offset, length, priority), media.file_size)
+        _indexes[media.key] = ranges
+        if len(_indexes) > 1024:
+            _indexes.popitem(last=False)
+    pinned = 0
+    for start, end in ranges:
+        for chunk_index in range(start // CHUNK_SIZE, end // CHUNK_SIZE + 1):
+            if not chunk_cache.pin(media.key + (chunk_index,), await streamer.chunk(chunk_index, priority), ttl):
+                logger.warning(f"📌 Pin budget full, index of {media.key} only partly pinned")
+                return ranges
+            pinned += 1
+    if pinned:
+        logger.info(f"📌 Pinned {pinned} index chunk(s) of {media.key}: {ranges}")
+    return ranges
+async def read_index(client, media, ttl):
+    """[(offset, bytes)] of every pinned index range of a file."""
+    ranges = await pin_index(client, media, ttl)
+    streamer = TurboStreamer(client, media, 0, media.file_size - 1)
+    return [(start, await streamer.read(start, end - start + 1)) for start, end in ranges]
+def schedule_index_pin(client, media, link):
+    """Background pin_index() for a link being streamed, once per file."""
+    if secret.PIN_CACHE_MB <= 0 or media.key in _indexes or media.key in _tasks:
+        return
+    task = _tasks[media.key] = asyncio.create_task(_pin_quietly(client, media, seconds_left(link)))
+    task.add_done_callback(lambda t: _tasks.pop(media.key, None))
+async def _pin_quietly(client, media, ttl):
+    try:
+        await pin_index(client, media, ttl)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Index pinning of {media.key} failed: {e}")
@@ -0,0 +1,253 @@
+import os
+import time
+import mmap
+import asyncio
+import logging
+import datetime
+import secret
+from database.db import db
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 1024 * 1024
+CACHE_SUBDIR = "titanium_chunks"  # Created inside DISK_CACHE_DIR; the only place the cache ever deletes from
+SEND_SLICE = 512 * 1024  # sendfile() piece size when a flow paces and times the response
+class _Segment:
+    """One sparse file per media; chunks land at their real byte offset."""
+    __slots__ = ("path", "chunks", "size", "created", "last_access")
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = {}  # chunk_index -> stored length
+        self.size = 0
+        self.created = time.time()
+        self.last_access = self.created
+class DiskCache:
+    """
+    Optional second cache tier on local disk (DISK_CACHE_DIR).
+
+    Chunks pulled from Telegram are written once into a per-file segment.
+    Fully cached ranges are pushed with sendfile(), partially cached ones are
+    read back as mmap slices, so neither path copies bytes through Python.
+    Segments are evicted LRU under DISK_CACHE_MB, after DISK_CACHE_HOURS,
+    or as soon as no live link in db.links points at them any more.
+    """
+    def __init__(self, root, max_bytes, max_age, chunk_size=CHUNK_SIZE):
+        # Our own subdirectory, so DISK_CACHE_DIR=/tmp (or a shared volume) is never wiped
+        self.root = os.path.join(root, CACHE_SUBDIR) if root else root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.enabled = bool(root) and max_bytes > 0
+        self._segments = {}  # (chat_id, message_id) -> _Segment
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.expired = 0
+        self.sendfile_bytes = 0
+
+    def reset(self):
+        """Delete the last run's segments on boot; the chunk index only lives in RAM."""
+        if not self.enabled:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        for name in os.listdir(self.root):
+            if name.endswith(".seg"):
+                try:
+                    os.unlink(os.path.join(self.root, name))
+                except OSError:
+                    pass
+        self._segments.clear()
+        self.size = 0
+        logger.info(f"💽 Disk chunk cache ready at {self.root} ({self.max_bytes // (1024 * 1024)} MB)")
+
+    # ================= WRITE PATH =================
+    async def store(self, key, chunk_index, data):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        seg = self._segments.get(key)
+        if seg is not None and chunk_index in seg.chunks:
+            return
+        if seg is None:
+            seg = self._segments[key] = _Segment(os.path.join(self.root, f"{key[0]}_{key[1]}.seg"))
+        try:
+            await asyncio.to_thread(self._pwrite, seg.path, chunk_index * self.chunk_size, data)
+        except OSError as e:
+            logger.warning(f"Disk cache write failed for {key}: {e}")
+            return
+        # The segment may have been evicted while we were writing
+        if self._segments.get(key) is not seg or chunk_index in seg.chunks:
+            return
+        seg.chunks[chunk_index] = len(data)
+        seg.size += len(data)
+        seg.last_access = time.time()
+        self.size += len(data)
+        self.writes += 1
+        self._enforce_budget(keep=key)
+
+    @staticmethod
+    def _pwrite(path, offset, data):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    # ================= READ PATH =================
+    def read(self, key, chunk_index):
+        """Return a zero-copy mmap view of a cached chunk, or None."""
+        if not self.enabled:
+            return None
+        seg = self._segments.get(key)
+        length = seg.chunks.get(chunk_index) if seg else None
+        if not length:
+            self.misses += 1
+            return None
+        try:
+            with open(seg.path, "rb") as f:
+                # The mapping keeps its own fd; it is unmapped once the last view is dropped
+                mm = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=chunk_index * self.chunk_size)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Disk cache read failed for {key}: {e}")
+            self._drop(key)
+            self.misses += 1
+            return None
+        seg.last_access = time.time()
+        self.hits += 1
+        return memoryview(mm)
+
+    def covers(self, key, start, end):
+        """True if every byte of [start, end] is already on disk."""
+        seg = self._segments.get(key) if self.enabled else None
+        if seg is None:
+            return False
+        last = end // self.chunk_size
+        for i in range(start // self.chunk_size, last + 1):
+            length = seg.chunks.get(i)
+            if length is None:
+                return False
+            if i < last and length < self.chunk_size:
+                return False
+        return seg.chunks[last] > end % self.chunk_size
+
+    async def sendfile(self, request, response, key, start, end, flow=None):
+        """
+        Push [start, end] straight from the segment file with loop.sendfile()
+        and finish the response. It must already be prepared. Returns False
+        when the span is not fully cached so the caller can use TurboStreamer.
+        With a `flow` the span goes out in SEND_SLICE pieces, each paced by
+        the shaper and bounded by the write timeout.
+        """
+        if not self.covers(key, start, end):
+            return False
+        seg = self._segments[key]
+        seg.last_access = time.time()
+        transport = request.transport
+        if transport is None:
+            return True
+        # Newer aiohttp buffers the status line until the first body write
+        writer = getattr(response, "_payload_writer", None)
+        send_headers = getattr(writer, "send_headers", None)
+        if send_headers:
+            send_headers()
+        count = end - start + 1
+        try:
+            with open(seg.path, "rb") as f:
+                try:
+                    loop = asyncio.get_running_loop()
+                    if flow:
+                        for offset in range(start, end + 1, SEND_SLICE):
+                            piece = min(SEND_SLICE, end + 1 - offset)
+                            await flow.send(piece, lambda: loop.sendfile(transport, f, offset, piece))
+                    else:
+                        await loop.sendfile(transport, f, start, count)
+                except NotImplementedError:
+                    # TLS / exotic transports: fall back to mmap slices
+                    for i in range(start // self.chunk_size, end // self.chunk_size + 1):
+                        view = self.read(key, i)
+                        if view is None:
+                            raise ConnectionResetError("Disk segment vanished mid-transfer")
+                        base = i * self.chunk_size
+                        piece = view[max(start, base) - base:min(end, base + len(view) - 1) - base + 1]
+                        if flow:
+                            await flow.send(len(piece), lambda: response.write(piece))
+                        else:
+                            await response.write(piece)
+            await response.write_eof()
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            pass  # Client disconnected or stopped reading
+        self.hits += 1
+        self.sendfile_bytes += count
+        return True
+
+    # ================= EVICTION =================
+    def _drop(self, key):
+        seg = self._segments.pop(key, None)
+        if seg is None:
+            return
+        self.size -= seg.size
+        try:
+            os.unlink(seg.path)
+        except OSError:
+            pass
+
+    def _enforce_budget(self, keep=None):
+        now = time.time()
+        for key, seg in list(self._segments.items()):
+            if now - seg.created > self.max_age:
+                self._drop(key)
+                self.expired += 1
+        while self.size > self.max_bytes:
+            victims = [k for k in self._segments if k != keep]
+            if not victims:
+                break
+            lru = min(victims, key=lambda k: self._segments[k].last_access)
+            self._drop(lru)
+            self.evictions += 1
+
+    def clear(self):
+        for key in list(self._segments):
+            self._drop(key)
+
+    async def sweep(self):
+        """Free segments whose links were killed or expired out of db.links."""
+        if not self._segments:
+            self._enforce_budget()
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        live = set()
+        async for doc in db.links.find({"expires_at": {"$gt": now}}, {"chat_id": 1, "message_id": 1}):
+            live.add((doc.get("chat_id"), doc.get("message_id")))
+        for key in list(self._segments):
+            if key not in live:
+                self._drop(key)
+                self.expired += 1
+        self._enforce_budget()
+
+    async def run_sweeper(self, interval=300):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"Disk cache sweep failed: {e}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "segments": len(self._segments),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "sendfile_bytes": self.sendfile_bytes,
+        }
+# 💽 Disk tier (disabled unless DISK_CACHE_DIR is set)
+disk_cache = DiskCache(
+    secret.DISK_CACHE_DIR,
+    secret.DISK_CACHE_MB * 1024 * 1024,
+    secret.DISK_CACHE_HOURS * 3600,
+)
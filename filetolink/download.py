@@ -1,76 +1,76 @@
-import re
 import logging
 import asyncio
 import traceback
 from aiohttp import web
-from database.db import db
 from filetolink.stream import pyro_client
-from filetolink.fast import TurboStreamer
+from filetolink.fast import TurboStreamer, readahead_window
+from filetolink.disk_cache import disk_cache
+from filetolink.budget import stream_budget
+from filetolink.ranges import plan_ranges, file_etag
+from filetolink.media import resolve_media
+from filetolink.links import get_link
+from filetolink.ttfb import ttfb_stats
+from filetolink.shaper import bandwidth_shaper
 logger = logging.getLogger(__name__)
 async def handle_download(request: web.Request) -> web.StreamResponse:
+    started = asyncio.get_running_loop().time()  # For the TTFB report
     hash_id = request.match_info.get('hash_id')
-    link_data = await db.get_link(hash_id)
+    link_data = await get_link(hash_id)
     if not link_data:
         return web.Response(text="❌ 404 - Link Expired", status=404)
     try:
-        message = await pyro_client.get_messages(link_data['chat_id'], link_data['message_id'])
-        media = getattr(message, "document", None) or getattr(message, "video", None) or getattr(message, "audio", None)
+        # 🎞️ Straight from the stored descriptor (no get_messages per range request)
+        media = await resolve_media(pyro_client, link_data['_id'], link_data)
         if not media:
             return web.Response(text="❌ Media not found", status=404)
-        file_size = int(getattr(media, 'file_size', 0))
-        filename = link_data.get('file_name') or getattr(media, 'file_name', 'file')  # Fix: Handle None
-        offset = 0
-        limit = file_size - 1
-        range_header = request.headers.get('Range')
-       
-        # Range Request Parsing (For IDM/Resume)
-        if range_header:
-            m = re.match(r'bytes=(\d+)-(\d*)', range_header)
-            if m:
-                offset = int(m.group(1))
-                if m.group(2):
-                    limit = int(m.group(2))
+        file_size = media.file_size
+        filename = link_data.get('file_name') or media.file_name or 'file'  # Fix: Handle None
+        mime_type = media.mime_type or 'application/octet-stream'
+        # 🎯 Shared range + conditional layer (IDM/aria2 resume, If-Range, 416)
+        plan = plan_ranges(request, file_size, file_etag(media.file_unique_id or media.message_id, file_size))
+        if isinstance(plan, web.Response):
+            return plan
+        headers = plan.headers(mime_type)
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
         # HEAD request (IDM checks file size first)
-        headers = {
-            'Content-Type': getattr(media, 'mime_type', 'application/octet-stream'),
-            'Content-Disposition': f'attachment; filename="{filename}"',
-            'Accept-Ranges': 'bytes',
-            'Content-Length': str(limit - offset + 1)
-        }
-        if range_header:
-            headers['Content-Range'] = f'bytes {offset}-{limit}/{file_size}'
-            status = 206
-        else:
-            status = 200
         if request.method == 'HEAD':
-            return web.Response(status=status, headers=headers)
-        response = web.StreamResponse(status=status, headers=headers)
+            return web.Response(status=plan.status, headers=headers)
+        response = web.StreamResponse(status=plan.status, headers=headers)
         response.enable_compression(False) # 🔥 Disable compression for max speed
         await response.prepare(request)
-        # 🔥 INTELLIGENT WORKER SCALING 🔥
-        req_size = limit - offset + 1
-        # On Render free tier, always use 1 worker to save RAM and avoid OOM
-        worker_count = 1
-        # -----------------------------
-        # TURBO STREAM ENGINE (RENDER SAFE TUNING)
-        # -----------------------------
-        streamer = TurboStreamer(
-            pyro_client,
-            message,
-            offset_bytes=offset,
-            limit_bytes=limit,
-            workers=worker_count, # Apply our smart worker logic
-            # Removed chunk_size: It's hardcoded in fast.py
-        )
-        async for chunk in streamer.generate():
+        # 🚰 Paced by the shaper: fair share by the owner's tier under the egress ceiling
+        flow = await bandwidth_shaper.open(request, link_data)
+        try:
+            # 💽 Span already on disk? Let the kernel push it (sendfile)
+            if len(plan.ranges) == 1 and await disk_cache.sendfile(request, response, media.key, *plan.ranges[0], flow=flow):
+                return response
+            def open_stream(start, end):
+                req_size = end - start + 1
+                # 🔥 Budget-aware: a lone IDM download gets many fetchers, a crowded box falls back to 1
+                worker_count = stream_budget.grant("dl") if req_size > 1024 * 1024 else 1
+                # -----------------------------
+                # TURBO STREAM ENGINE (RENDER SAFE TUNING)
+                # -----------------------------
+                streamer = TurboStreamer(
+                    pyro_client,
+                    media,
+                    offset_bytes=start,
+                    limit_bytes=end,
+                    workers=worker_count, # Apply our smart worker logic
+                    readahead_bytes=readahead_window("dl", file_size),
+                    kind="dl",
+                    premium=link_data.get("premium", False)
+                )
+                return streamer.generate()
+            await plan.write_body(response, mime_type, open_stream, flow)
+            if plan.first_byte_at is not None:
+                ttfb_stats.record("dl", plan.first_byte_at - started, f"bytes={plan.ranges[0][0]}-{plan.ranges[-1][1]}")
             try:
-                await response.write(chunk)
+                await response.write_eof()
             except Exception:
-                break # Client disconnected
-        try:
-            await response.write_eof()
-        except Exception:
-            pass
+                pass
+        finally:
+            flow.close()
            
         return response
     except Exception as e:
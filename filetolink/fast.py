@@ -1,94 +1,403 @@
+import math
 import asyncio
 import logging
-from pyrogram.errors import FloodWait
+from pyrogram.errors import FloodWait, FileReferenceExpired
+import secret
+from filetolink.cache import chunk_cache, inflight
+from filetolink.disk_cache import disk_cache
+from filetolink.clients import get_client_pool
+from filetolink.budget import stream_budget
+from filetolink.scheduler import fetch_scheduler, fetch_priority
+from filetolink.hedge import hedger
 logger = logging.getLogger(__name__)
+MB = 1024 * 1024
+def readahead_window(kind, file_size, duration=0):
+    """
+    Read-ahead depth in bytes: STREAM_READAHEAD_SECONDS of media at the file's
+    average bitrate for /stream (short, seeks are cheap), a flat
+    DL_READAHEAD_MB for /dl (deep, download managers read flat out).
+    """
+    if kind == "dl":
+        return secret.DL_READAHEAD_MB * MB
+    cap = secret.STREAM_READAHEAD_MB * MB
+    if file_size and duration:
+        return max(MB, min(cap, int(file_size / duration * secret.STREAM_READAHEAD_SECONDS)))
+    return cap
 class TurboStreamer:
-    def __init__(self, client, message, offset_bytes, limit_bytes, workers=1):  # Changed default to 1 for Render free tier
+    def __init__(self, client, media, offset_bytes, limit_bytes, workers=1, readahead_bytes=4 * MB, kind="stream", premium=False):  # Changed default to 1 for Render free tier
         self.client = client
-        self.message = message
+        self.media = media  # MediaRef: descriptor from the link document
+        self.kind = kind  # "stream" or "dl": decides the fetch priority class
+        self.premium = premium
+        # First fetch size when the starting chunk isn't cached (0 = always fetch whole chunks)
+        self.slow_start_bytes = secret.SLOW_START_KB * 1024
         self.offset_bytes = offset_bytes
         self.limit_bytes = limit_bytes
         self.chunk_size = 1024 * 1024  # 1MB Chunks for perfect speed balancing
         self.workers = workers
+        # Sliding window: never hold more than this many chunks ahead of the client
+        self.window = max(1, math.ceil(readahead_bytes / self.chunk_size))
         
         # Calculate start and end chunk indexes
         self.start_chunk = self.offset_bytes // self.chunk_size
         self.end_chunk = self.limit_bytes // self.chunk_size
         self.req_length = self.limit_bytes - self.offset_bytes + 1
+        # Shared cache identity: same file => same chunks for every viewer
+        self.cache_key = self.media.key
+        # Raw GetFile on persistent media sessions, spread over the bot + helper clients
+        self.pool = get_client_pool(client)
+
+    async def _get(self, offset, length, priority):
+        """Fetch [offset, offset + length) from Telegram; returns (data, seconds)."""
+        loop = asyncio.get_running_loop()
+        # 🚦 Every GetFile goes through the global scheduler (priority + learned rate)
+        await fetch_scheduler.acquire(priority)
+        async with self.pool.lease(self.media) as member:
+            file_id = await member.file_id(self.media)
+            started = loop.time()
+            try:
+                data = await member.fetcher.fetch(file_id, offset, length)
+            except FileReferenceExpired:
+                # Stale reference: re-read the message once (helpers just look up their copy again)
+                if member.primary:
+                    await self.media.refresh(self.client, stale=file_id)
+                else:
+                    member.forget(self.media.key)
+                raise
+            except FloodWait as e:
+                fetch_scheduler.on_flood(e.value)
+                raise
+        fetch_scheduler.on_success()
+        return data, loop.time() - started
+
+    async def _fetch(self, chunk_index, priority):
+        chunk_data, seconds = await self._get(chunk_index * self.chunk_size, self.chunk_size, priority)
+        # Only full chunks feed the latency / throughput history
+        hedger.record(seconds)
+        stream_budget.record_fetch(len(chunk_data), seconds)
+        chunk_cache.put(self.cache_key + (chunk_index,), chunk_data)
+        return chunk_data
+
+    async def chunk(self, chunk_index, priority=None):
+        """One whole chunk via the caches, fetching (and caching) it on a miss."""
+        key = self.cache_key + (chunk_index,)
+        data = chunk_cache.get(key)
+        if data is None:
+            data = disk_cache.read(self.cache_key, chunk_index)
+        if data is not None:
+            return data
+        priority = priority or fetch_priority(self.kind, False, self.premium)
+        # Counts against the global budget like any stream buffer (and waits behind them)
+        await stream_budget.reserve(self.chunk_size)
+        try:
+            for attempt in range(5):
+                try:
+                    data = await inflight.run(key, lambda: self._fetch(chunk_index, priority))
+                    break
+                except (FileReferenceExpired, FloodWait):
+                    if attempt == 4:
+                        raise  # Reference refreshed / client drained inside _get; retry
+            await disk_cache.store(self.cache_key, chunk_index, data)
+            return data
+        finally:
+            stream_budget.release(self.chunk_size)
+
+    async def read(self, offset, length, priority=None):
+        """Bytes at [offset, offset + length) (fewer at EOF), assembled from whole chunks."""
+        end = min(offset + length, self.media.file_size)
+        parts = []
+        pos = offset
+        while pos < end:
+            chunk_index = pos // self.chunk_size
+            data = await self.chunk(chunk_index, priority)
+            lo = pos - chunk_index * self.chunk_size
+            hi = min(end - chunk_index * self.chunk_size, len(data))
+            if hi <= lo:
+                break
+            parts.append(data[lo:hi])
+            pos += hi - lo
+        return b"".join(parts)
+
+    async def peek(self, offset, length, priority=None):
+        """
+        A few bytes somewhere in the file (sparse lookups such as subtitle
+        blocks): sliced from a cached chunk if there is one, else fetched as
+        just the aligned parts covering them rather than whole chunks.
+        """
+        end = min(offset + length, self.media.file_size)
+        chunk_index = offset // self.chunk_size
+        if end <= offset or (end - 1) // self.chunk_size != chunk_index:
+            return await self.read(offset, length, priority)
+        data = chunk_cache.get(self.cache_key + (chunk_index,))
+        if data is None:
+            data = disk_cache.read(self.cache_key, chunk_index)
+        if data is not None:
+            lo = offset - chunk_index * self.chunk_size
+            return bytes(data[lo:lo + end - offset])
+        priority = priority or fetch_priority(self.kind, False, self.premium)
+        for attempt in range(5):
+            try:
+                data, _ = await self._get(offset, end - offset, priority)
+                return bytes(data)
+            except (FileReferenceExpired, FloodWait):
+                if attempt == 4:
+                    raise  # Reference refreshed / client drained inside _get; retry
+
+    async def warm(self, chunk_indexes):
+        """Pull chunks into the memory and disk caches without streaming them (link warm-up)."""
+        priority = fetch_priority("dl", False, self.premium)  # Bulk: never ahead of a viewer
+        for chunk_index in chunk_indexes:
+            await self.chunk(chunk_index, priority)
+
+    async def _slow_start(self, end):
+        """
+        Serve the head of an uncached first chunk (up to `end`, exclusive)
+        from small aligned fetches that double towards a full chunk, so the
+        first bytes go out after a 64 KB round trip instead of a 1 MB one.
+        The pieces are requested together, so the head as a whole arrives
+        no later than one full-chunk fetch would. The parts of the chunk
+        outside the head are fetched alongside at normal priority, and the
+        shared in-flight fetch joins everything into the chunk the caches
+        keep, so each byte still comes from Telegram once. A viewer opening
+        a position someone else is already fetching just waits for that
+        chunk and sends no pieces.
+        """
+        pieces = []
+        pos = self.offset_bytes
+        size = self.slow_start_bytes
+        while pos < end:
+            piece_end = min(end, (pos // size + 1) * size)
+            pieces.append((pos, piece_end - pos))
+            pos = piece_end
+            size = min(size * 2, self.chunk_size)
+        priority = fetch_priority(self.kind, True, self.premium)
+        base = self.start_chunk * self.chunk_size
+        chunk_end = min(base + self.chunk_size, self.media.file_size)
+
+        async def piece(offset, length, priority):
+            for attempt in range(5):
+                try:
+                    data, _ = await self._get(offset, length, priority)
+                    return data
+                except (FileReferenceExpired, FloodWait):
+                    continue  # Reference refreshed / client drained inside _get
+                except Exception as e:
+                    logger.warning(f"Slow-start fetch at {offset} failed: {e}")
+                    await asyncio.sleep(1)
+            raise Exception(f"Failed to fetch bytes at {offset} after 5 retries.")
+
+        # Registered in the in-flight table right away, so viewers opening this spot
+        # in the same tick already find it and join instead of sending their own pieces
+        key = self.cache_key + (self.start_chunk,)
+        joined = inflight.pending(key)
+        tasks = parts = []
+        if not joined:
+            tasks = [asyncio.create_task(piece(offset, length, priority)) for offset, length in pieces]
+            rest = fetch_priority(self.kind, False, self.premium)
+            before = [asyncio.create_task(piece(base, self.offset_bytes - base, rest))] if self.offset_bytes > base else []
+            after = [asyncio.create_task(piece(end, chunk_end - end, rest))] if end < chunk_end else []
+            parts = before + tasks + after
+        shared = inflight.start(key, lambda: self._join(parts))
+        if not joined:
+            shared.add_done_callback(self._store_fetched)
+        # Holds this viewer's claim on the shared fetch: cancelled only if it leaves early
+        full = asyncio.create_task(inflight.wait(key, shared))
+        served = False
+        try:
+            if joined:
+                # 📦 Someone else is pulling this chunk: the head comes out of it
+                await asyncio.wait((full,))
+                if full.cancelled() or full.exception():
+                    data = await self.chunk(self.start_chunk, priority)  # Joined fetch failed: fetch it ourselves
+                else:
+                    data = full.result()
+                head = memoryview(data)[self.offset_bytes - base:end - base]
+                if len(head) < end - self.offset_bytes:
+                    raise Exception("File ended early.")
+                served = True
+                yield head
+                return
+            for task, (offset, length) in zip(tasks, pieces):
+                # Shielded: the piece belongs to the shared fetch, not to this viewer
+                data = await asyncio.shield(task)
+                if len(data) < length:
+                    raise Exception("File ended early.")
+                yield data
+            served = True
+        finally:
+            if not served:
+                full.cancel()  # Viewer left: the shared fetch (and its pieces) go too unless someone else waits on it
+            full.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _join(self, parts):
+        """The first chunk put together from a slow start's parts; cancelling it cancels them."""
+        try:
+            data = b"".join([await part for part in parts])
+        except BaseException:
+            for part in parts:
+                part.cancel()
+            raise
+        chunk_cache.put(self.cache_key + (self.start_chunk,), data)
+        return data
+
+    def _store_fetched(self, task):
+        """Copy a slow start's shared full-chunk fetch to the disk tier once it lands."""
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(disk_cache.store(self.cache_key, self.start_chunk, task.result()))
 
     async def generate(self):
-        # The Queue holds the chunk numbers we need to fetch
-        queue = asyncio.Queue()
-        for i in range(self.start_chunk, self.end_chunk + 1):
-            await queue.put(i)  # Use await put for async safety
-        
         # The Buffer holds the downloaded bytes: { chunk_index: b'data' }
         buffer = {}
+        # Bytes each buffered chunk reserved in the global stream budget
+        held = {}
         # The Condition notifies the main loop when a chunk arrives
         condition = asyncio.Condition()
         
         # Worker Flag to stop them if things go wrong
         active = True
+        loop = asyncio.get_running_loop()
+        # When each chunk's Telegram fetch began, and any hedge fired for it
+        started = {}
+        hedges = {}
+        fetching = {}  # chunk_index -> the owning worker's fetch, cancelled when a hedge wins
+
+        def deliver(chunk_index, chunk_data):
+            # Call with the condition held. The slower of a hedged pair must not re-enter the buffer
+            if chunk_index < delivered or chunk_index in buffer:
+                return False
+            buffer[chunk_index] = chunk_data
+            condition.notify_all()
+            return True
+
+        async def hedge(chunk_index):
+            # 🏎️ Duplicate fetch for the chunk the client is stuck on; the pool leases the least busy session
+            try:
+                chunk_data = await self._fetch(chunk_index, fetch_priority(self.kind, True, self.premium))
+            except Exception as e:
+                logger.debug(f"Hedge for chunk {chunk_index} failed: {e}")
+                return
+            async with condition:
+                stalled = fetching.get(chunk_index)
+                if deliver(chunk_index, chunk_data) and stalled is not None and not stalled.done():
+                    stalled.cancel()  # Frees the worker that owns the chunk to claim the next one
+                    hedger.won += 1
 
         async def worker():
-            nonlocal active
+            nonlocal active, next_chunk
             while active:
-                try:
-                    # Get the next chunk index to fetch
-                    chunk_index = await queue.get()
-                except asyncio.CancelledError:
-                    break
+                async with condition:
+                    # Only claim chunks inside the read-ahead window; it slides as the client drains
+                    while active and next_chunk <= self.end_chunk and next_chunk >= current_chunk + self.window:
+                        await condition.wait()
+                    if not active or next_chunk > self.end_chunk:
+                        break
+                    chunk_index = next_chunk
+                    next_chunk += 1
+                
+                # Another viewer (or an earlier seek) may already have pulled it
+                cached = chunk_cache.get(self.cache_key + (chunk_index,))
+                if cached is None:
+                    cached = disk_cache.read(self.cache_key, chunk_index)
+                if cached is not None:
+                    async with condition:
+                        deliver(chunk_index, cached)
+                    continue
+                
+                # 🧠 Wait for room in the global budget (the chunk the client is blocked on never waits)
+                urgent = chunk_index == current_chunk
+                await stream_budget.reserve(self.chunk_size, urgent=urgent)
+                held[chunk_index] = self.chunk_size
+                priority = fetch_priority(self.kind, urgent, self.premium)
                 
                 retries = 0
-                while retries < 5 and active:
+                started[chunk_index] = loop.time()
+                # Stop early if a hedge already delivered this chunk
+                while retries < 5 and active and chunk_index >= delivered and chunk_index not in buffer:
+                    # Fetch exactly 1 chunk (1MB) from Telegram, or join a fetch already in flight.
+                    # Its own task, so a winning hedge can cancel it without cancelling the worker
+                    fetch = fetching[chunk_index] = asyncio.create_task(
+                        inflight.run(self.cache_key + (chunk_index,), lambda: self._fetch(chunk_index, priority))
+                    )
                     try:
-                        # Fetch exactly 1 chunk (1MB) from Telegram
-                        chunk_data = b""
-                        async for data in self.client.stream_media(
-                            self.message,
-                            offset=chunk_index,
-                            limit=1
-                        ):
-                            chunk_data += data
+                        chunk_data = await fetch
                         
                         # Store in buffer and notify main loop
                         async with condition:
-                            buffer[chunk_index] = chunk_data
-                            condition.notify_all()
+                            deliver(chunk_index, chunk_data)
+                        await disk_cache.store(self.cache_key, chunk_index, chunk_data)
                         break  # Success!
                     
-                    except FloodWait as e:
-                        # If Telegram says "Wait 3s", we wait, then retry
-                        await asyncio.sleep(e.value + 1)
+                    except asyncio.CancelledError:
+                        if asyncio.current_task().cancelling():
+                            raise  # The stream is shutting down
+                        break  # A hedge delivered this chunk first
+                    except FileReferenceExpired:
+                        # _fetch already refreshed the reference, just retry
+                        retries += 1
+                    except FloodWait:
+                        # The pool drained that client; the next lease picks another (or waits it out)
                         retries += 1
                     except Exception as e:
                         # Unknown error? Wait 1s and retry
                         logger.warning(f"Worker Error on chunk {chunk_index}: {e}")
                         await asyncio.sleep(1)
                         retries += 1
+                    finally:
+                        fetching.pop(chunk_index, None)
                 
                 if retries >= 5:
                     # If we failed 5 times, we must stop the stream to prevent hanging
                     logger.error(f"Critical: Failed to fetch chunk {chunk_index} after 5 retries.")
+                    stream_budget.release(held.pop(chunk_index, 0))
                     active = False
                     async with condition:
                         condition.notify_all()  # Wake up main loop to crash safely
-                
-                queue.task_done()
 
-        # 🔥 LAUNCH PARALLEL WORKERS 🔥
-        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
-        
         current_chunk = self.start_chunk
+        next_chunk = self.start_chunk
+        delivered = self.start_chunk  # Chunks below this have been handed to the consumer
         bytes_remaining = self.req_length
         first_part_cut = self.offset_bytes % self.chunk_size
         
+        # 🐢 Slow start: if the first chunk has to come from Telegram, the consumer serves
+        # its head from small growing fetches while the workers start on the next chunk
+        slow_end = None
+        first = chunk_cache.get(self.cache_key + (self.start_chunk,))
+        if first is None:
+            first = disk_cache.read(self.cache_key, self.start_chunk)
+        if first is not None:
+            buffer[self.start_chunk] = first
+            next_chunk += 1
+        elif self.slow_start_bytes:
+            slow_end = min((self.start_chunk + 1) * self.chunk_size, self.limit_bytes + 1)
+            next_chunk += 1
+        first = None
+        
+        # 🔥 LAUNCH PARALLEL WORKERS 🔥
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        stream_budget.open()
+        
         try:
+            if slow_end is not None:
+                async for data in self._slow_start(slow_end):
+                    yield data
+                    bytes_remaining -= len(data)
+                async with condition:
+                    current_chunk += 1
+                    delivered = current_chunk
+                    condition.notify_all()
+            
             while current_chunk <= self.end_chunk and bytes_remaining > 0:
                 async with condition:
-                    # Wait until the CURRENT chunk is ready in the buffer
+                    # Wait until the CURRENT chunk is ready in the buffer, hedging a fetch that stalls
                     while current_chunk not in buffer and active:
-                        await condition.wait()
+                        try:
+                            await asyncio.wait_for(condition.wait(), hedger.threshold())
+                        except asyncio.TimeoutError:
+                            began = started.get(current_chunk)
+                            if (began is not None and current_chunk not in hedges
+                                    and loop.time() - began >= hedger.threshold() and hedger.allow()):
+                                hedges[current_chunk] = asyncio.create_task(hedge(current_chunk))
                     
                     # If workers died and chunk is missing, stop stream
                     if not active and current_chunk not in buffer:
@@ -96,26 +405,38 @@ class TurboStreamer:
                     
                     # Grab data and delete from RAM immediately
                     data = buffer.pop(current_chunk)
+                    delivered = current_chunk + 1
+                started.pop(current_chunk, None)
+                loser = hedges.pop(current_chunk, None)
+                if loser is not None:
+                    loser.cancel()
                 
                 # Slice the first chunk if the user requested a specific byte offset (Resume/Seek)
+                # and trim the last one, both as views so the chunk is never copied
                 if current_chunk == self.start_chunk and first_part_cut:
-                    data = data[first_part_cut:]
-                
-                # Trim the last chunk if it's larger than needed
+                    data = memoryview(data)[first_part_cut:]
                 if len(data) > bytes_remaining:
-                    data = data[:bytes_remaining]
+                    data = memoryview(data)[:bytes_remaining]
                 
                 yield data
                 bytes_remaining -= len(data)
-                current_chunk += 1
+                # Written out: hand its share of the budget back and slide the window
+                stream_budget.release(held.pop(current_chunk, 0))
+                async with condition:
+                    current_chunk += 1
+                    condition.notify_all()
         
         finally:
             # Clean up: Kill workers and free RAM
             active = False
-            for task in tasks:
+            for task in tasks + list(hedges.values()):
                 task.cancel()
             try:
                 await asyncio.gather(*tasks, return_exceptions=True)
             except:
                 pass
             buffer.clear()
+            for nbytes in held.values():
+                stream_budget.release(nbytes)
+            held.clear()
+            stream_budget.close()
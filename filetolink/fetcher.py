@@ -0,0 +1,113 @@
+import logging
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+import secret
+from filetolink.sessions import MediaSessionPool
+logger = logging.getLogger(__name__)
+# upload.GetFile rules: offset and limit are multiples of 4 KB, limit divides
+# 1 MB, and one request never crosses a 1 MB boundary.
+MIN_PART = 4 * 1024
+MAX_PART = 1024 * 1024
+INVOKE_RETRIES = 1  # Session-level retries on a broken socket; the streamer retries the rest itself
+TIMEOUT_RETRIES = 1  # Times a timed-out request moves on to another session before giving up
+def get_location(file_id: FileId):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+def plan_parts(offset, length):
+    """
+    Split [offset, offset + length) into legal GetFile (offset, limit) pairs.
+    Each part uses the smallest power-of-two limit that finishes the span,
+    so a 64 KB read costs one 64 KB request instead of a full megabyte.
+    """
+    parts = []
+    pos = offset
+    end = offset + length
+    while pos < end:
+        target = min(end, pos - pos % MAX_PART + MAX_PART)
+        limit = MIN_PART
+        while True:
+            aligned = pos - pos % limit
+            if aligned + limit >= target:
+                break
+            limit *= 2
+        parts.append((aligned, limit))
+        pos = aligned + limit
+    return parts
+class MediaFetcher:
+    """
+    Downloads file bytes with raw upload.GetFile on the client's pool of
+    persistent media sessions, instead of paying stream_media()'s session
+    setup for every chunk.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.pool = MediaSessionPool(client, secret.MEDIA_SESSIONS_PER_DC)
+
+    async def fetch(self, file_id: FileId, offset, length):
+        """Return exactly `length` bytes at `offset` (fewer only at EOF), as
+        the received bytes or a memoryview trimmed out of them."""
+        if length <= 0:
+            return b""
+        location = get_location(file_id)
+        plan = plan_parts(offset, length)
+        parts = []
+        slow = None  # Session that timed out, skipped when the rest is retried
+        for attempt in range(TIMEOUT_RETRIES + 1):
+            async with self.pool.lease(file_id.dc_id, avoid=slow) as session:
+                try:
+                    for part_offset, limit in plan[len(parts):]:
+                        # sleep_threshold=0: a FloodWait must reach the client pool and the scheduler's
+                        # back-off instead of being slept here while holding the lease and the budget
+                        r = await session.invoke(
+                            raw.functions.upload.GetFile(location=location, offset=part_offset, limit=limit),
+                            retries=INVOKE_RETRIES,
+                            sleep_threshold=0,
+                        )
+                        data = r.bytes if isinstance(r, raw.types.upload.File) else b""
+                        parts.append((part_offset, data))
+                        if len(data) < limit:
+                            break  # EOF
+                    break
+                except TimeoutError:
+                    # Slow, not broken: other requests multiplexed on this session are
+                    # still fine, so leave it up and carry on from another one
+                    if attempt == TIMEOUT_RETRIES:
+                        raise
+                    slow = session
+                except OSError:
+                    # Broken socket: swap in a fresh connection on the next lease
+                    await self.pool.discard(file_id.dc_id, session)
+                    raise
+        # Trim the aligned parts down to exactly what was asked for, without copying
+        skip = offset - parts[0][0]
+        if len(parts) == 1:
+            data = parts[0][1]
+            if skip == 0 and len(data) <= length:
+                return data
+            return memoryview(data)[skip:skip + length]
+        # Several parts: join just the wanted bytes, copied once
+        return b"".join(
+            memoryview(data)[max(offset - part_offset, 0):offset + length - part_offset]
+            for part_offset, data in parts
+        )
+
+    async def close(self):
+        await self.pool.close()
+_fetchers = {}
+def get_fetcher(client):
+    """One fetcher (and one media session pool) per Pyrogram client."""
+    fetcher = _fetchers.get(client.name)
+    if fetcher is None:
+        fetcher = _fetchers[client.name] = MediaFetcher(client)
+    return fetcher
@@ -0,0 +1,57 @@
+import logging
+from collections import deque
+import secret
+logger = logging.getLogger(__name__)
+class Hedger:
+    """
+    Decides when the chunk a client is blocked on has been in flight long
+    enough to fire a duplicate fetch on another session.
+
+    The threshold is the p95 of recent fetch times (never below
+    `min_delay`), and hedges are capped at `max_ratio` of all fetches so a
+    slow DC can't double the load on Telegram.
+    """
+    def __init__(self, max_ratio, min_delay, window=200):
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self._samples = deque(maxlen=window)
+        self._p95 = None
+        self._dirty = False
+        self.fetches = 0
+        self.hedges = 0
+        self.won = 0
+        self.denied = 0
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self.fetches += 1
+        self._dirty = True
+
+    def threshold(self):
+        if self._dirty:
+            ordered = sorted(self._samples)
+            self._p95 = ordered[int(len(ordered) * 0.95)] if len(ordered) >= 20 else None
+            self._dirty = False
+        return max(self.min_delay, self._p95 or 1.0)
+
+    def allow(self):
+        if self.max_ratio <= 0:
+            return False
+        # A couple of hedges are allowed before there is a fetch history
+        if self.hedges + 1 > self.max_ratio * self.fetches + 2:
+            self.denied += 1
+            return False
+        self.hedges += 1
+        return True
+
+    def stats(self):
+        return {
+            "threshold_ms": round(self.threshold() * 1000, 1),
+            "fetches": self.fetches,
+            "hedges": self.hedges,
+            "won": self.won,
+            "denied": self.denied,
+            "hedge_rate": round(self.hedges / self.fetches, 4) if self.fetches else 0.0,
+        }
+# 🏎️ One hedger (and one latency history) for the whole web tier
+hedger = Hedger(secret.HEDGE_MAX_PERCENT / 100, secret.HEDGE_MIN_MS / 1000)
@@ -0,0 +1,82 @@
+import math
+import logging
+import traceback
+from collections import OrderedDict
+from aiohttp import web
+import secret
+from database.db import seconds_left
+from filetolink.stream import pyro_client
+from filetolink.media import resolve_media
+from filetolink.links import get_link
+from filetolink.container import read_index, parse_moov, fragment_segments, on_index_reset
+logger = logging.getLogger(__name__)
+# HLS over the raw file: only fragmented MP4 (CMAF-style moof/mdat) can be cut
+# into byte-range segments that players accept without remuxing
+_plans = OrderedDict()  # media key -> (init_end, [(start, end, seconds)]) or None
+on_index_reset(_plans.clear)
+def merge_segments(segments, target):
+    """Join consecutive fragments until each segment lasts at least `target` seconds."""
+    merged = []
+    for start, end, seconds in segments:
+        if merged and merged[-1][2] < target:
+            first, _, total = merged[-1]
+            merged[-1] = (first, end, total + seconds)
+        else:
+            merged.append((start, end, seconds))
+    return merged
+async def build_plan(client, media, ttl):
+    """(init_end, segments) for a fragmented MP4, or None if HLS can't serve it."""
+    boxes = {}
+    for start, data in await read_index(client, media, ttl):
+        boxes.setdefault(bytes(data[4:8]), (start, data))
+    if b"moov" not in boxes:
+        return None
+    moov_start, moov = boxes[b"moov"]
+    info = parse_moov(moov)
+    if not info["fragmented"] or not info["track"]:
+        return None
+    segments = fragment_segments(boxes, info)
+    if not segments:
+        return None  # Fragments without sidx / mfra: finding them means reading the whole file
+    return moov_start + len(moov) - 1, merge_segments(segments, secret.HLS_SEGMENT_SECONDS)
+def render_playlist(plan, media_url):
+    init_end, segments = plan
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max(s[2] for s in segments))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+        f'#EXT-X-MAP:URI="{media_url}",BYTERANGE="{init_end + 1}@0"',
+    ]
+    for start, end, seconds in segments:
+        lines += [f"#EXTINF:{seconds:.3f},", f"#EXT-X-BYTERANGE:{end - start + 1}@{start}", media_url]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+async def handle_hls(request: web.Request):
+    hash_id = request.match_info.get('hash_id')
+    link_data = await get_link(hash_id)
+    if not link_data:
+        return web.Response(text="❌ 404 - Link Expired", status=404)
+    try:
+        media = await resolve_media(pyro_client, link_data['_id'], link_data)
+        if not media:
+            return web.Response(text="❌ Media not found", status=404)
+        if media.key in _plans:
+            plan = _plans[media.key]
+        else:
+            plan = _plans[media.key] = await build_plan(pyro_client, media, seconds_left(link_data))
+            if len(_plans) > 1024:
+                _plans.popitem(last=False)
+        if plan is None:
+            return web.Response(text="❌ HLS needs a fragmented MP4 with a sidx or mfra index, use /stream", status=415)
+        # 🎬 Every segment is a byte range of /stream, so it runs through the normal chunk pipeline
+        return web.Response(
+            text=render_playlist(plan, f"/stream/{hash_id}"),
+            content_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "private, max-age=300"},
+        )
+    except Exception as e:
+        logger.error(f"HLS Error: {traceback.format_exc()}")
+        return web.Response(text="❌ 500 - Internal Server Error", status=500)
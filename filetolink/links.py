@@ -0,0 +1,45 @@
+import logging
+import secret
+from database.db import db, LinkCache
+from filetolink import timer
+logger = logging.getLogger(__name__)
+_SIGNING_KEY = secret.LINK_SIGNING_KEY.encode()
+# Token links are checked in memory; their link data is remembered for as
+# long as the token lives (bounded by the token's own expiry)
+_token_links = LinkCache(secret.LINK_CACHE_SIZE, 24 * 3600, 0)
+def make_url_id(hash_id, chat_id, message_id, size, expires_at):
+    """What goes in /dl, /stream and /watch URLs for a new link."""
+    if not _SIGNING_KEY:
+        return hash_id
+    return timer.sign_link_token(_SIGNING_KEY, hash_id, chat_id, message_id, size, expires_at)
+async def get_link(url_id):
+    """
+    Link data for a URL id, or None if it is unknown, expired or revoked.
+
+    Signed tokens are validated without touching Mongo; the `file_links`
+    document (same `_id` as the token's link id) is only read once per
+    process to pick up the stored media descriptor and file name.
+    Plain hashes go through the regular database lookup.
+    """
+    claims = timer.verify_link_token(_SIGNING_KEY, url_id) if _SIGNING_KEY else None
+    if claims is None:
+        return await db.get_link(url_id)
+    if db.is_link_revoked(claims["issued_at"]):
+        return None
+    link_id = claims["link_id"]
+    found, link = _token_links.get(link_id)
+    if not found:
+        doc = await db.get_link(link_id)
+        link = {
+            "_id": link_id,
+            "chat_id": claims["chat_id"],
+            "message_id": claims["message_id"],
+            "file_name": doc.get("file_name") if doc else None,
+            "size": doc.get("size") if doc else None,
+            "media": doc.get("media") if doc else None,
+            "premium": doc.get("premium", False) if doc else False,
+            "owner_id": doc.get("owner_id") if doc else None,
+            "expires_at": claims["expires_at"],
+        }
+        _token_links.put(link_id, link)
+    return link
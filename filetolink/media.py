@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from pyrogram.file_id import FileId
+from database.db import db
+logger = logging.getLogger(__name__)
+def media_of(message):
+    return getattr(message, "document", None) or getattr(message, "video", None) or getattr(message, "audio", None)
+def describe_media(media):
+    """
+    Build the descriptor stored in the link document. Works for both
+    python-telegram-bot and Pyrogram media objects (same attribute names).
+    """
+    duration = getattr(media, "duration", 0) or 0
+    if hasattr(duration, "total_seconds"):
+        duration = duration.total_seconds()
+    return {
+        "file_id": media.file_id,
+        "file_unique_id": getattr(media, "file_unique_id", None),
+        "dc_id": FileId.decode(media.file_id).dc_id,
+        "file_size": int(getattr(media, "file_size", 0) or 0),
+        "mime_type": getattr(media, "mime_type", None),
+        "file_name": getattr(media, "file_name", None),
+        "duration": int(duration),
+    }
+class MediaRef:
+    """
+    A file the web tier can stream, built from the descriptor saved in its
+    link document, so serving bytes needs no get_messages() round trip.
+    """
+    def __init__(self, hash_id, chat_id, message_id, doc):
+        self.hash_id = hash_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.doc = doc  # Same dict as link_data["media"]: refreshes update it in place
+        self._decoded = (None, None)
+        self._lock = asyncio.Lock()
+
+    @property
+    def file_id(self):
+        raw_id = self.doc["file_id"]
+        if self._decoded[0] != raw_id:
+            self._decoded = (raw_id, FileId.decode(raw_id))
+        return self._decoded[1]
+
+    @property
+    def key(self):
+        """Cache identity shared by every link pointing at this message."""
+        return (self.chat_id, self.message_id)
+
+    @property
+    def file_size(self):
+        return self.doc.get("file_size") or 0
+
+    @property
+    def mime_type(self):
+        return self.doc.get("mime_type")
+
+    @property
+    def file_name(self):
+        return self.doc.get("file_name")
+
+    @property
+    def file_unique_id(self):
+        return self.doc.get("file_unique_id")
+
+    @property
+    def duration(self):
+        return self.doc.get("duration") or 0
+
+    @property
+    def mirror(self):
+        """Copy in STREAM_CHANNEL_ID that helper bots can read, if any."""
+        return self.doc.get("mirror")
+
+    async def refresh(self, client, stale=None):
+        """
+        Re-read the message for a fresh file reference after Telegram answers
+        FILE_REFERENCE_EXPIRED. Concurrent callers holding the same `stale`
+        FileId only trigger one lookup.
+        """
+        async with self._lock:
+            if stale is not None and self.file_id is not stale:
+                return
+            message = await client.get_messages(self.chat_id, self.message_id)
+            media = media_of(message)
+            if not media:
+                raise ValueError("Media not found")
+            self.doc.update(describe_media(media))
+            await db.update_link_media(self.hash_id, self.doc)
+            logger.info(f"🔄 File reference refreshed for link {self.hash_id}")
+async def resolve_media(client, hash_id, link_data):
+    """
+    MediaRef for a link. Links created before descriptors were stored get
+    one get_messages() lookup, after which the descriptor is saved.
+    """
+    doc = link_data.get("media")
+    if doc:
+        return MediaRef(hash_id, link_data["chat_id"], link_data["message_id"], doc)
+    message = await client.get_messages(link_data["chat_id"], link_data["message_id"])
+    media = media_of(message)
+    if not media:
+        return None
+    doc = link_data["media"] = describe_media(media)
+    await db.update_link_media(hash_id, doc)
+    return MediaRef(hash_id, link_data["chat_id"], link_data["message_id"], doc)
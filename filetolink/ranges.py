@@ -0,0 +1,169 @@
+import re
+import asyncio
+import hashlib
+import secrets
+import logging
+from aiohttp import web
+logger = logging.getLogger(__name__)
+# Shared RFC 7233 / RFC 7232 layer for /stream and /dl
+MAX_RANGES = 16  # More parts than this after coalescing = just send the whole file
+_SPEC = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+class RangeNotSatisfiable(Exception):
+    pass
+def parse_range(header, size):
+    """
+    Parse a `Range: bytes=...` header into sorted, coalesced (start, end)
+    pairs, both inclusive. Handles `a-b`, `a-`, suffix `-n` and lists.
+    Returns None when the header should be ignored (bad syntax, other unit,
+    too many parts) and raises RangeNotSatisfiable when it is valid but
+    nothing in it overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        m = _SPEC.match(part)
+        if not m or (not m.group(1) and not m.group(2)):
+            return None
+        first, last = m.group(1), m.group(2)
+        if not first:
+            # Suffix range: the final N bytes (players grab the MP4 moov this way)
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            end = min(int(last), size - 1) if last else size - 1
+        if start <= end:
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        prev_start, prev_end = merged[-1]
+        if start <= prev_end + 1:
+            merged[-1] = (prev_start, max(prev_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+def file_etag(*identity):
+    """Strong ETag derived from the file's identity (never from the link)."""
+    digest = hashlib.sha1("|".join(str(i) for i in identity).encode()).hexdigest()[:24]
+    return f'"{digest}"'
+def _etag_list(header):
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+def _weak_match(header, etag):
+    tags = _etag_list(header)
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+class RangePlan:
+    """What to send: status code, byte ranges and the matching headers."""
+    def __init__(self, status, ranges, size, etag):
+        self.status = status
+        self.ranges = ranges
+        self.size = size
+        self.etag = etag
+        self.boundary = secrets.token_hex(12) if len(ranges) > 1 else None
+        self.first_byte_at = None  # Loop time the first body byte was written (TTFB)
+
+    @property
+    def multipart(self):
+        return self.boundary is not None
+
+    def _part_header(self, start, end, mime_type):
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Type: {mime_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n"
+        ).encode()
+
+    def _closing(self):
+        return f"--{self.boundary}--\r\n".encode()
+
+    def headers(self, mime_type):
+        headers = {"Accept-Ranges": "bytes", "ETag": self.etag}
+        if self.multipart:
+            length = sum(len(self._part_header(s, e, mime_type)) + (e - s + 1) + 2 for s, e in self.ranges)
+            headers["Content-Type"] = f"multipart/byteranges; boundary={self.boundary}"
+            headers["Content-Length"] = str(length + len(self._closing()))
+            return headers
+        start, end = self.ranges[0] if self.ranges else (0, -1)
+        headers["Content-Type"] = mime_type
+        headers["Content-Length"] = str(end - start + 1)
+        if self.status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{self.size}"
+        return headers
+
+    async def write_body(self, response, mime_type, open_stream, flow=None):
+        """
+        Stream every planned range into a prepared response. `open_stream`
+        maps (start, end) to an async iterator of bytes. Every write goes
+        through `flow` (shaper pacing, write timeout) when given. Returns False
+        if the client went away or stalled mid-transfer.
+        """
+        loop = asyncio.get_running_loop()
+        for start, end in self.ranges:
+            if self.multipart and not await _safe_write(response, self._part_header(start, end, mime_type), flow):
+                return False
+            gen = open_stream(start, end)
+            try:
+                async for chunk in gen:
+                    if not await _safe_write(response, chunk, flow):
+                        return False
+                    if self.first_byte_at is None:
+                        self.first_byte_at = loop.time()
+            finally:
+                await gen.aclose()
+            if self.multipart and not await _safe_write(response, b"\r\n", flow):
+                return False
+        if self.multipart:
+            return await _safe_write(response, self._closing(), flow)
+        return True
+async def _safe_write(response, data, flow=None):
+    try:
+        if flow:
+            await flow.send(len(data), lambda: response.write(data))
+        else:
+            await response.write(data)
+        return True
+    except Exception:
+        return False  # Client disconnected or stopped reading
+def plan_ranges(request, size, etag, start=None):
+    """
+    Apply If-None-Match, If-Range and Range to a file of `size` bytes.
+    Returns a RangePlan, or a finished 304 / 416 web.Response. `start`
+    (a ?t= seek) turns a request without a Range into `bytes=start-`; a
+    Range, even `bytes=0-`, is answered as asked, since a 206 must start
+    where the client said.
+    """
+    base = {"ETag": etag, "Accept-Ranges": "bytes"}
+    inm = request.headers.get("If-None-Match")
+    if inm and _weak_match(inm, etag):
+        return web.Response(status=304, headers=base)
+    full = RangePlan(200, [(0, size - 1)] if size else [], size, etag)
+    header = request.headers.get("Range")
+    if not header:
+        if start and start < size:
+            return RangePlan(206, [(start, size - 1)], size, etag)
+        return full
+    # If-Range only honours a strong, exact match; anything else gets the whole file
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range.strip() != etag:
+        return full
+    try:
+        ranges = parse_range(header, size)
+    except RangeNotSatisfiable:
+        return web.Response(status=416, headers={**base, "Content-Range": f"bytes */{size}"})
+    if ranges is None:
+        return full
+    return RangePlan(206, ranges, size, etag)
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from collections import Counter
+import secret
+from filetolink.shaper import bandwidth_shaper
+logger = logging.getLogger(__name__)
+REAP_INTERVAL = 10  # Seconds between sweeps
+MIN_RATE_GRACE = 30  # Seconds a flow must have spent blocked on its client before the throughput floor applies
+class SlowClientReaper:
+    """
+    Periodically closes responses that hold a streamer without using it.
+
+    A flow is reaped when nothing has been written for STALL_SECONDS
+    (client gone quiet, or stuck behind a fetch that will never finish),
+    or when the client has been draining slower than MIN_CLIENT_KBPS over
+    the time our writes spent waiting on it. Closing the transport makes
+    aiohttp cancel the handler, which stops its workers and their
+    Telegram fetches and gives the buffers back to the stream budget.
+    """
+    def __init__(self, stall_seconds, min_rate):
+        self.stall_seconds = stall_seconds
+        self.min_rate = min_rate  # Bytes/s, 0 = no floor
+        self.reaped = Counter()  # reason -> count
+        self.sweeps = 0
+
+    def verdict(self, flow, now):
+        """Why `flow` should be closed, or None to leave it be."""
+        if self.stall_seconds and now - flow.progress_at > self.stall_seconds:
+            return "stalled"
+        if self.min_rate and flow.blocked > MIN_RATE_GRACE and flow.sent / flow.blocked < self.min_rate:
+            return "too_slow"
+        return None
+
+    def sweep(self):
+        now = asyncio.get_running_loop().time()
+        self.sweeps += 1
+        for flow in list(bandwidth_shaper.flows):
+            reason = self.verdict(flow, now)
+            if reason is None:
+                continue
+            logger.info(f"🪓 Reaping {reason} client on link {flow.group[0]}: {flow.sent} bytes in {now - flow.opened_at:.0f}s")
+            self.reaped[reason] += 1
+            flow.abort()
+            flow.close()  # Stop judging it; the handler's own close() is then a no-op
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Reaper sweep failed: {e}")
+
+    def stats(self):
+        return {
+            "stall_seconds": self.stall_seconds,
+            "min_client_kbps": self.min_rate // 1024,
+            "sweeps": self.sweeps,
+            "reaped": dict(self.reaped),
+        }
+# 🪓 One reaper over every flow the shaper knows about
+reaper = SlowClientReaper(secret.STALL_SECONDS, secret.MIN_CLIENT_KBPS * 1024)
@@ -0,0 +1,508 @@
+import struct
+import asyncio
+import logging
+import traceback
+from aiohttp import web
+from filetolink.stream import pyro_client
+from filetolink.fast import TurboStreamer, readahead_window
+from filetolink.budget import stream_budget
+from filetolink.media import resolve_media
+from filetolink.links import get_link
+from filetolink.ttfb import ttfb_stats
+from filetolink.shaper import bandwidth_shaper
+from filetolink.container import (
+    read_vint, iter_elements, EBML_HEADER, MKV_SEGMENT, MKV_SEEK_HEAD, MKV_INFO,
+    MKV_TIMECODE_SCALE, MKV_CLUSTER, MKV_CUES,
+)
+logger = logging.getLogger(__name__)
+# 🔁 MKV -> fragmented MP4 on the fly: the codec data is copied untouched,
+# only the container around it is rewritten, one moof/mdat per keyframe
+TIMESCALE = 1000  # MKV timestamps are (almost always) milliseconds
+SKIP_REOPEN = 4 * 1024 * 1024  # Skipping more than this restarts the input at the target offset
+MAX_FRAGMENT_BYTES = 8 * 1024 * 1024  # Flush early if a GOP grows beyond this
+# Matroska element ids (see container.py for the index-related ones)
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_NUMBER = 0xD7
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_CODEC_PRIVATE = 0x63A2
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_CONTENT_ENCODINGS = 0x6D80
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_AUDIO = 0xE1
+MKV_SAMPLING_FREQUENCY = 0xB5
+MKV_CHANNELS = 0x9F
+MKV_TIMECODE = 0xE7
+MKV_SIMPLE_BLOCK = 0xA3
+MKV_BLOCK_GROUP = 0xA0
+MKV_BLOCK = 0xA1
+MKV_REFERENCE_BLOCK = 0xFB
+MKV_ATTACHMENTS = 0x1941A469
+MKV_CHAPTERS = 0x1043A770
+MKV_TAGS = 0x1254C367
+LEVEL1_IDS = {MKV_SEEK_HEAD, MKV_INFO, MKV_TRACKS, MKV_CLUSTER, MKV_CUES, MKV_ATTACHMENTS, MKV_CHAPTERS, MKV_TAGS}
+VIDEO_CODECS = {"V_MPEG4/ISO/AVC": (b"avc1", b"avcC"), "V_MPEGH/ISO/HEVC": (b"hvc1", b"hvcC")}
+AAC_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+KEY_FLAGS = 0x02000000  # sample_depends_on = 2 (independent)
+DELTA_FLAGS = 0x01010000  # depends on others, non-sync
+class UnsupportedMedia(Exception):
+    pass
+class EbmlReader:
+    """
+    Forward-only reader over a file streamed in chunks. Only the bytes not
+    yet consumed are buffered, and long skips (attachments, tags) reopen
+    the input at the target offset instead of downloading what they jump.
+    """
+    def __init__(self, open_stream):
+        self._open = open_stream
+        self._chunks = None
+        self._buf = bytearray()
+        self._start = 0
+        self.pos = 0
+        self.fetched = 0  # Bytes pulled from the input so far
+
+    async def _fill(self, n):
+        if self._chunks is None:
+            self._chunks = self._open(self.pos)
+        while len(self._buf) - self._start < n:
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                return False
+            del self._buf[:self._start]
+            self._start = 0
+            self._buf += chunk
+            self.fetched += len(chunk)
+        return True
+
+    async def read(self, n):
+        if not await self._fill(n):
+            raise EOFError("MKV ended mid-element")
+        data = bytes(self._buf[self._start:self._start + n])
+        self._start += n
+        self.pos += n
+        return data
+
+    async def skip(self, n):
+        buffered = len(self._buf) - self._start
+        if n - buffered > SKIP_REOPEN:
+            await self.close()
+            self.pos += n
+            return
+        while n > 0:
+            if len(self._buf) == self._start and not await self._fill(1):
+                raise EOFError("MKV ended mid-element")
+            step = min(n, len(self._buf) - self._start)
+            self._start += step
+            self.pos += step
+            n -= step
+
+    async def seek(self, pos):
+        """Move forward to `pos`, reopening the input there unless it is already buffered."""
+        if pos < self.pos:
+            raise ValueError("EbmlReader only moves forward")
+        if pos - self.pos <= len(self._buf) - self._start:
+            await self.skip(pos - self.pos)
+        else:
+            await self.close()
+            self.pos = pos
+
+    async def _vint(self, keep_marker=False):
+        first = await self.read(1)
+        length = 9 - first[0].bit_length() if first[0] else 0
+        data = first + (await self.read(length - 1) if length > 1 else b"")
+        return read_vint(data, 0, keep_marker)[0]
+
+    async def header(self):
+        """(element_id, data_size) of the next element; size -1 = unknown."""
+        element_id = await self._vint(keep_marker=True)
+        return element_id, await self._vint()
+
+    async def close(self):
+        if self._chunks is not None:
+            await self._chunks.aclose()
+        self._chunks = None
+        self._buf = bytearray()
+        self._start = 0
+def _uint(data):
+    return int.from_bytes(data, "big")
+def _float(data):
+    return struct.unpack(">f" if len(data) == 4 else ">d", data)[0] if len(data) in (4, 8) else 0.0
+def children(body, start=0, end=None):
+    """(element_id, bytes) of each child element in an EBML master's body."""
+    for element_id, pos, size in iter_elements(body, start, len(body) if end is None else end):
+        yield element_id, body[pos:pos + size]
+class Track:
+    """One MKV track carried into the MP4, with the samples of the open fragment."""
+    def __init__(self, mp4_id, kind, entry):
+        self.mp4_id = mp4_id
+        self.kind = kind
+        self.entry = entry  # stsd sample entry box
+        self.default = 0  # Frame duration in TIMESCALE units, 0 = unknown
+        self.samples = []  # (pts, data, keyframe)
+        self.width = self.height = 0
+def _box(box_type, *payload):
+    body = b"".join(payload)
+    return struct.pack(">I", 8 + len(body)) + box_type + body
+def _full_box(box_type, version, flags, *payload):
+    return _box(box_type, struct.pack(">I", (version << 24) | flags), *payload)
+def _descriptor(tag, payload):
+    size = len(payload)
+    return bytes([tag, 0x80 | (size >> 21) & 0x7F, 0x80 | (size >> 14) & 0x7F, 0x80 | (size >> 7) & 0x7F, size & 0x7F]) + payload
+def _video_track(mp4_id, codec, private, settings):
+    sample_type, config_type = VIDEO_CODECS[codec]
+    track = Track(mp4_id, "video", None)
+    track.width = _uint(settings.get(MKV_PIXEL_WIDTH, b""))
+    track.height = _uint(settings.get(MKV_PIXEL_HEIGHT, b""))
+    track.entry = _box(
+        sample_type, bytes(6), struct.pack(">H", 1), bytes(16),
+        struct.pack(">HHIIIH", track.width, track.height, 0x480000, 0x480000, 0, 1),
+        bytes(32), struct.pack(">Hh", 0x18, -1), _box(config_type, private),
+    )
+    return track
+def _audio_track(mp4_id, codec, private, settings):
+    rate = int(_float(settings.get(MKV_SAMPLING_FREQUENCY, b"")) or 48000)
+    channels = _uint(settings.get(MKV_CHANNELS, b"")) or 2
+    if not private:
+        # Old-style codec ids carry the profile in the name instead of an AudioSpecificConfig
+        if "LC" not in codec or rate not in AAC_RATES:
+            return None
+        private = ((2 << 11) | (AAC_RATES.index(rate) << 7) | (channels << 3)).to_bytes(2, "big")
+    config = _descriptor(4, bytes([0x40, 0x15]) + bytes(11) + _descriptor(5, private))
+    esds = _full_box(b"esds", 0, 0, _descriptor(3, struct.pack(">HB", mp4_id, 0) + config + _descriptor(6, b"\x02")))
+    track = Track(mp4_id, "audio", _box(
+        b"mp4a", bytes(6), struct.pack(">H", 1), bytes(8),
+        struct.pack(">HHHHI", channels, 16, 0, 0, rate << 16 if rate < 65536 else 0), esds,
+    ))
+    track.default = round(1024 * TIMESCALE / rate)
+    return track
+def parse_tracks(body):
+    """{MKV track number: Track} for the first H.264/HEVC video and first AAC audio track."""
+    picked = {}
+    audio = []  # Codec ids of every audio track, to refuse files whose sound we'd drop
+    for element_id, entry in children(body):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        fields = dict(children(entry))
+        if MKV_CONTENT_ENCODINGS in fields:
+            continue  # Compressed / encrypted frames can't be copied as-is
+        kind = _uint(fields.get(MKV_TRACK_TYPE, b""))
+        codec = fields.get(MKV_CODEC_ID, b"").rstrip(b"\0").decode("ascii", "replace")
+        private = fields.get(MKV_CODEC_PRIVATE, b"")
+        number = _uint(fields.get(MKV_TRACK_NUMBER, b""))
+        track = None
+        if kind == 2:
+            audio.append(codec)
+        if kind == 1 and codec in VIDEO_CODECS and private and "video" not in picked:
+            track = _video_track(1, codec, private, dict(children(fields.get(MKV_VIDEO, b""))))
+        elif kind == 2 and codec.startswith("A_AAC") and "audio" not in picked:
+            track = _audio_track(2, codec, private, dict(children(fields.get(MKV_AUDIO, b""))))
+        if track:
+            if MKV_DEFAULT_DURATION in fields:
+                track.default = round(_uint(fields[MKV_DEFAULT_DURATION]) * TIMESCALE / 1e9) or track.default
+            picked[track.kind] = (number, track)
+    if "video" not in picked:
+        raise UnsupportedMedia("no H.264 / HEVC video track")
+    if audio and "audio" not in picked:
+        # AC3 / E-AC3 / DTS / Opus / FLAC: a silent remux is worse than the raw file
+        raise UnsupportedMedia(f"audio is {', '.join(sorted(set(audio)))}, only AAC can be remuxed")
+    return {number: track for number, track in picked.values()}
+def block_frames(data):
+    """(track number, relative time, keyframe flag, [frames]) of a (Simple)Block, lacing included."""
+    track, length = read_vint(data, 0)
+    relative = struct.unpack_from(">h", data, length)[0]
+    flags = data[length + 2]
+    pos = length + 3
+    lacing = (flags >> 1) & 3
+    if not lacing:
+        return track, relative, bool(flags & 0x80), [data[pos:]]
+    count = data[pos] + 1
+    pos += 1
+    sizes = []
+    if lacing == 1:  # Xiph
+        for _ in range(count - 1):
+            size = 0
+            while data[pos] == 255:
+                size += 255
+                pos += 1
+            size += data[pos]
+            pos += 1
+            sizes.append(size)
+    elif lacing == 3:  # EBML: first size, then signed differences
+        size, length = read_vint(data, pos)
+        pos += length
+        sizes.append(size)
+        for _ in range(count - 2):
+            delta, length = read_vint(data, pos)
+            pos += length
+            size += delta - ((1 << (7 * length - 1)) - 1)
+            sizes.append(size)
+    else:  # Fixed
+        sizes = [(len(data) - pos) // count] * (count - 1)
+    sizes.append(len(data) - pos - sum(sizes))
+    frames = []
+    for size in sizes:
+        frames.append(data[pos:pos + size])
+        pos += size
+    return track, relative, bool(flags & 0x80), frames
+async def read_head(reader):
+    """
+    Walk an MKV up to its first Cluster: the Segment's data offset, the Info
+    and Tracks bodies and the first Cluster's header as (id, size, offset).
+    """
+    element_id, size = await reader.header()
+    if element_id != EBML_HEADER:
+        raise UnsupportedMedia("not a Matroska file")
+    await reader.skip(size)
+    element_id, _ = await reader.header()
+    if element_id != MKV_SEGMENT:
+        raise UnsupportedMedia("no Segment element")
+    head = {"segment": reader.pos, "info": b"", "tracks": None}
+    while True:
+        start = reader.pos
+        element_id, size = await reader.header()
+        if element_id == MKV_CLUSTER:
+            if head["tracks"] is None:
+                raise UnsupportedMedia("clusters before Tracks")
+            head["cluster"] = (element_id, size, start)
+            return head
+        if size < 0:
+            raise UnsupportedMedia("unknown-size element before the first cluster")
+        if element_id == MKV_INFO:
+            head["info"] = await reader.read(size)
+        elif element_id == MKV_TRACKS:
+            head["tracks"] = await reader.read(size)
+        else:
+            await reader.skip(size)
+async def iter_blocks(reader, pending, wanted_clusters=None, only_track=None, single_cluster=False):
+    """
+    Walk the clusters from the reader's position and yield (cluster
+    timecode, block, group) per SimpleBlock / BlockGroup, `group` being the
+    BlockGroup's children (None for a SimpleBlock). `pending` is a header
+    already read, as (id, size, offset). Clusters whose offset isn't in
+    `wanted_clusters` are skipped, and with `only_track` other tracks'
+    SimpleBlocks are skipped without being buffered. `single_cluster`
+    stops after the first cluster read.
+    """
+    while True:
+        if pending:
+            (element_id, size, start), pending = pending, None
+        else:
+            start = reader.pos
+            try:
+                element_id, size = await reader.header()
+            except EOFError:
+                return
+        if element_id != MKV_CLUSTER or (wanted_clusters is not None and size >= 0 and start not in wanted_clusters):
+            if size < 0:
+                return
+            await reader.skip(size)
+            continue
+        cluster_end = reader.pos + size if size >= 0 else None
+        cluster_time = 0
+        while cluster_end is None or reader.pos < cluster_end:
+            start = reader.pos
+            try:
+                element_id, size = await reader.header()
+            except EOFError:
+                return
+            if element_id in LEVEL1_IDS:
+                pending = (element_id, size, start)  # Unknown-size cluster just ended
+                break
+            if element_id == MKV_TIMECODE:
+                cluster_time = _uint(await reader.read(size))
+            elif element_id == MKV_SIMPLE_BLOCK:
+                block = await reader.read(min(size, 8))
+                if only_track is not None and read_vint(block, 0)[0] != only_track:
+                    await reader.skip(size - len(block))
+                    continue
+                yield cluster_time, block + await reader.read(size - len(block)), None
+            elif element_id == MKV_BLOCK_GROUP:
+                group = dict(children(await reader.read(size)))
+                if MKV_BLOCK in group:
+                    yield cluster_time, group[MKV_BLOCK], group
+            else:
+                await reader.skip(size)
+        if single_cluster:
+            return
+class MkvRemuxer:
+    """Reads an MKV front to back and yields an fMP4 init segment, then fragments."""
+    def __init__(self, reader):
+        self.reader = reader
+        self.timecode_scale = 1000000
+        self.duration = 0
+        self.tracks = None
+        self._pending = None  # First Cluster header, read by start()
+        self._sequence = 0
+        self._bytes = 0
+
+    def _ticks(self, timecode):
+        return round(timecode * self.timecode_scale * TIMESCALE / 1e9)
+
+    async def start(self):
+        """Parse up to the first Cluster and return the init segment (ftyp + moov)."""
+        head = await read_head(self.reader)
+        fields = dict(children(head["info"]))
+        self.timecode_scale = _uint(fields.get(MKV_TIMECODE_SCALE, b"")) or 1000000
+        self.duration = self._ticks(_float(fields.get(MKV_DURATION, b"")))
+        self.tracks = parse_tracks(head["tracks"])
+        self._pending = head["cluster"]
+        return self.init_segment()
+
+    def init_segment(self):
+        traks = [self._trak(track) for track in self.tracks.values()]
+        trex = [_full_box(b"trex", 0, 0, struct.pack(">5I", t.mp4_id, 1, 0, 0, 0)) for t in self.tracks.values()]
+        mvhd = _full_box(
+            b"mvhd", 0, 0, struct.pack(">IIIIIH", 0, 0, TIMESCALE, self.duration, 0x10000, 0x100),
+            bytes(10), MATRIX, bytes(24), struct.pack(">I", 3),
+        )
+        mvex = _box(b"mvex", _full_box(b"mehd", 0, 0, struct.pack(">I", self.duration)), *trex)
+        ftyp = _box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isom", b"iso6", b"mp41")
+        return ftyp + _box(b"moov", mvhd, *traks, mvex)
+
+    def _trak(self, track):
+        video = track.kind == "video"
+        tkhd = _full_box(
+            b"tkhd", 0, 3, struct.pack(">IIIII", 0, 0, track.mp4_id, 0, self.duration), bytes(8),
+            struct.pack(">HHHH", 0, 0, 0 if video else 0x100, 0), MATRIX,
+            struct.pack(">II", track.width << 16, track.height << 16),
+        )
+        mdhd = _full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, TIMESCALE, self.duration, 0x55C4, 0))
+        hdlr = _full_box(b"hdlr", 0, 0, bytes(4), b"vide" if video else b"soun", bytes(12), b"Titanium\0")
+        header = _full_box(b"vmhd", 0, 1, bytes(8)) if video else _full_box(b"smhd", 0, 0, bytes(4))
+        dinf = _box(b"dinf", _full_box(b"dref", 0, 0, struct.pack(">I", 1), _full_box(b"url ", 0, 1)))
+        stbl = _box(
+            b"stbl", _full_box(b"stsd", 0, 0, struct.pack(">I", 1), track.entry),
+            _full_box(b"stts", 0, 0, bytes(4)), _full_box(b"stsc", 0, 0, bytes(4)),
+            _full_box(b"stsz", 0, 0, bytes(8)), _full_box(b"stco", 0, 0, bytes(4)),
+        )
+        return _box(b"trak", tkhd, _box(b"mdia", mdhd, hdlr, _box(b"minf", header, dinf, stbl)))
+
+    async def fragments(self):
+        """moof + mdat bytes, one per video keyframe (GOP), until the MKV ends."""
+        async for cluster_time, block, group in iter_blocks(self.reader, self._pending):
+            keyframe = None if group is None else MKV_REFERENCE_BLOCK not in group
+            fragment = self._add_block(block, cluster_time, keyframe)
+            if fragment:
+                yield fragment
+        fragment = self._flush()
+        if fragment:
+            yield fragment
+
+    def _add_block(self, data, cluster_time, keyframe):
+        number, relative, key_flag, frames = block_frames(data)
+        track = self.tracks.get(number)
+        if track is None:
+            return None  # Subtitles, extra audio, unsupported codecs
+        keyframe = key_flag if keyframe is None else keyframe
+        pts = self._ticks(cluster_time + relative)
+        fragment = None
+        if track.kind == "video" and keyframe and track.samples:
+            fragment = self._flush(boundary=pts)
+        elif self._bytes > MAX_FRAGMENT_BYTES:
+            fragment = self._flush()
+        for i, frame in enumerate(frames):
+            track.samples.append((pts + i * track.default, frame, keyframe or track.kind == "audio"))
+            self._bytes += len(frame)
+        return fragment
+
+    def _flush(self, boundary=None):
+        trafs = []
+        for track in self.tracks.values():
+            samples, track.samples = track.samples, []
+            if not samples:
+                continue
+            pts = [s[0] for s in samples]
+            # Blocks arrive in decode order with presentation times: the sorted
+            # presentation times, handed out in order, are the decode times
+            dts = sorted(pts) if track.kind == "video" else pts
+            durations = [max(b - a, 0) for a, b in zip(dts, dts[1:])]
+            if track.kind == "video" and boundary is not None and boundary > dts[-1]:
+                durations.append(boundary - dts[-1])
+            else:
+                durations.append(track.default or (durations[-1] if durations else 0))
+            entries = [
+                (duration, len(data), KEY_FLAGS if key else DELTA_FLAGS, p - d)
+                for (p, data, key), d, duration in zip(samples, dts, durations)
+            ]
+            trafs.append((track, max(dts[0], 0), entries, [s[1] for s in samples]))
+        self._bytes = 0
+        if not trafs:
+            return None
+        self._sequence += 1
+        def moof(offsets):
+            parts = [_full_box(b"mfhd", 0, 0, struct.pack(">I", self._sequence))]
+            for (track, base, entries, _), offset in zip(trafs, offsets):
+                trun = _full_box(
+                    b"trun", 1, 0xF01, struct.pack(">Ii", len(entries), offset),
+                    b"".join(struct.pack(">IIIi", *entry) for entry in entries),
+                )
+                tfhd = _full_box(b"tfhd", 0, 0x20000, struct.pack(">I", track.mp4_id))  # default-base-is-moof
+                parts.append(_box(b"traf", tfhd, _full_box(b"tfdt", 1, 0, struct.pack(">Q", base)), trun))
+            return _box(b"moof", *parts)
+        offsets, offset = [], len(moof([0] * len(trafs))) + 8
+        for _, _, _, frames in trafs:
+            offsets.append(offset)
+            offset += sum(len(frame) for frame in frames)
+        return moof(offsets) + _box(b"mdat", *(frame for traf in trafs for frame in traf[3]))
+async def handle_remux(request: web.Request):
+    started = asyncio.get_running_loop().time()  # For the TTFB report
+    hash_id = request.match_info.get('hash_id')
+    link_data = await get_link(hash_id)
+    if not link_data:
+        return web.Response(text="❌ 404 - Link Expired", status=404)
+    media = await resolve_media(pyro_client, link_data['_id'], link_data)
+    if not media:
+        return web.Response(text="❌ Media not found", status=404)
+    def open_stream(offset):
+        streamer = TurboStreamer(
+            pyro_client,
+            media,
+            offset_bytes=offset,
+            limit_bytes=media.file_size - 1,
+            workers=stream_budget.grant("stream"),
+            readahead_bytes=readahead_window("stream", media.file_size, media.duration),
+            kind="stream",
+            premium=link_data.get("premium", False)
+        )
+        return streamer.generate()
+    reader = EbmlReader(open_stream)
+    remuxer = MkvRemuxer(reader)
+    try:
+        init = await remuxer.start()
+    except (UnsupportedMedia, ValueError, IndexError, EOFError) as e:
+        await reader.close()
+        return web.Response(text=f"❌ Can't remux this file ({e}), use /stream", status=415)
+    # 🔁 Progressive fMP4: no length or ranges, the browser just plays as it arrives
+    response = web.StreamResponse(status=200, headers={
+        "Content-Type": "video/mp4",
+        "Cache-Control": "no-store",
+        "Accept-Ranges": "none",
+    })
+    response.enable_compression(False)
+    await response.prepare(request)
+    flow = await bandwidth_shaper.open(request, link_data)
+    try:
+        await flow.send(len(init), lambda: response.write(init))
+        first = True
+        async for fragment in remuxer.fragments():
+            await flow.send(len(fragment), lambda: response.write(fragment))
+            if first:
+                ttfb_stats.record("remux", asyncio.get_running_loop().time() - started, f"{media.key}")
+                first = False
+        await response.write_eof()
+    except (ValueError, IndexError, EOFError) as e:
+        logger.warning(f"🔁 Remux of {media.key} stopped on bad input: {e}")
+    except (ConnectionResetError, ConnectionError, asyncio.TimeoutError):
+        pass  # Client disconnected or stopped reading
+    except Exception:
+        logger.error(f"Remux Error: {traceback.format_exc()}")
+    finally:
+        flow.close()
+        await reader.close()
+    return response
@@ -0,0 +1,109 @@
+import heapq
+import asyncio
+import logging
+import itertools
+import secret
+logger = logging.getLogger(__name__)
+# Priority classes, most urgent first
+INTERACTIVE = 0  # A /stream viewer is blocked on this chunk (first chunk, seek)
+STREAM = 1  # /stream read-ahead
+BULK = 2  # /dl transfers
+CLASS_NAMES = {INTERACTIVE: "interactive", STREAM: "stream", BULK: "bulk"}
+def fetch_priority(kind, urgent, premium):
+    """Heap key prefix for one chunk fetch; premium links win ties within a class."""
+    if kind == "dl":
+        cls = BULK
+    else:
+        cls = INTERACTIVE if urgent else STREAM
+    return (cls, 0 if premium else 1)
+class FetchScheduler:
+    """
+    Single gate in front of every GetFile call in the process.
+
+    A shared token bucket paces fetches across all streams. Its rate is
+    learned AIMD-style: every FloodWait halves it (at most once per second),
+    every clean fetch nudges it back up towards FETCH_RATE_MAX. When the
+    bucket is empty, waiting fetches are released strictly by priority
+    class, so a viewer's seek never queues behind an IDM download.
+    """
+    def __init__(self, max_rate, min_rate, burst=8):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._stamp = None
+        self._heap = []  # (cls, tier, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._last_cut = 0.0
+        self.floods = 0
+        self.requested = {cls: 0 for cls in CLASS_NAMES}
+        self.waited = {cls: 0.0 for cls in CLASS_NAMES}
+
+    def _refill(self, now):
+        if self._stamp is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, priority):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._refill(now)
+        cls = priority[0]
+        self.requested[cls] += 1
+        if not self._heap and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        fut = loop.create_future()
+        heapq.heappush(self._heap, (*priority, next(self._seq), fut))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await fut
+        finally:
+            self.waited[cls] += loop.time() - now
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            self._refill(loop.time())
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            fut = heapq.heappop(self._heap)[-1]
+            if fut.done():
+                continue  # Waiter was cancelled (client left)
+            self.tokens -= 1
+            fut.set_result(None)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_flood(self, seconds):
+        self.floods += 1
+        now = asyncio.get_running_loop().time()
+        if now - self._last_cut < 1:
+            return  # One burst of FloodWaits is one signal
+        self._last_cut = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        logger.warning(f"🚦 FloodWait {seconds}s: fetch rate cut to {self.rate:.1f}/s")
+
+    def stats(self):
+        waiting = {name: 0 for name in CLASS_NAMES.values()}
+        for entry in self._heap:
+            if not entry[-1].done():
+                waiting[CLASS_NAMES[entry[0]]] += 1
+        return {
+            "rate_per_s": round(self.rate, 2),
+            "tokens": round(self.tokens, 2),
+            "floods": self.floods,
+            "waiting": waiting,
+            "requested": {CLASS_NAMES[c]: n for c, n in self.requested.items()},
+            "avg_wait_ms": {
+                CLASS_NAMES[c]: round(self.waited[c] / n * 1000, 1) if n else 0.0
+                for c, n in self.requested.items()
+            },
+        }
+# 🚦 One scheduler for every fetch in the web tier
+fetch_scheduler = FetchScheduler(secret.FETCH_RATE_MAX, secret.FETCH_RATE_MIN)
@@ -0,0 +1,55 @@
+import bisect
+import logging
+from collections import OrderedDict
+from filetolink.fast import TurboStreamer
+from filetolink.container import (
+    read_index, container_of, parse_moov, fragment_segments,
+    sample_table_keyframes, mkv_segment_info, cue_points, on_index_reset,
+)
+logger = logging.getLogger(__name__)
+# ⏩ Time -> byte offset for ?t= seeks, built on first use and kept per file
+_keyframes = OrderedDict()  # media key -> [(seconds, offset)] sorted, [] = no index
+on_index_reset(_keyframes.clear)
+async def build_keyframes(client, media, ttl):
+    """Every keyframe (seconds, byte offset) the container index knows about."""
+    entries = await read_index(client, media, ttl)
+    if not entries:
+        return []
+    streamer = TurboStreamer(client, media, 0, media.file_size - 1)
+    kind = container_of(await streamer.read(0, 16))
+    if kind == "mkv":
+        segment, timecode_scale = await mkv_segment_info(streamer.read)
+        return cue_points(entries[0][1], segment, timecode_scale)
+    boxes = {}
+    for start, data in entries:
+        boxes.setdefault(bytes(data[4:8]), (start, data))
+    if kind != "mp4" or b"moov" not in boxes:
+        return []
+    moov = boxes[b"moov"][1]
+    info = parse_moov(moov)
+    if not info["track"]:
+        return []
+    if not info["fragmented"]:
+        return sample_table_keyframes(moov, info["track"])
+    points, seconds = [], 0.0
+    for start, _, duration in fragment_segments(boxes, info) or []:
+        points.append((seconds, start))
+        seconds += duration
+    return points
+async def keyframe_at(client, media, ttl, seconds):
+    """(keyframe time, byte offset) of the last keyframe at or before `seconds`, or None."""
+    points = _keyframes.get(media.key)
+    if points is None:
+        try:
+            points = await build_keyframes(client, media, ttl)
+        except (ValueError, IndexError) as e:
+            logger.debug(f"Keyframe index of {media.key} unreadable: {e}")
+            points = []
+        _keyframes[media.key] = points
+        if len(_keyframes) > 1024:
+            _keyframes.popitem(last=False)
+        logger.info(f"⏩ Keyframe index of {media.key}: {len(points)} points")
+    if not points:
+        return None
+    i = bisect.bisect_right(points, (seconds, float("inf"))) - 1
+    return points[max(i, 0)]
@@ -1,11 +1,30 @@
 import os
 import logging
+import asyncio
+import traceback
 from aiohttp import web
+import secret
 from database.db import db
 # Import the Pyrogram handlers
 from filetolink.stream import pyro_client
 from filetolink.download import handle_download
 from filetolink.stream import handle_stream
+from filetolink.hls import handle_hls
+from filetolink.remux import handle_remux
+from filetolink.subs import handle_subs, handle_subs_list
+from filetolink.cache import chunk_cache, inflight
+from filetolink.disk_cache import disk_cache
+from filetolink.fetcher import get_fetcher
+from filetolink.clients import get_client_pool
+from filetolink.budget import stream_budget
+from filetolink.scheduler import fetch_scheduler
+from filetolink.hedge import hedger
+from filetolink.ttfb import ttfb_stats
+from filetolink.shaper import bandwidth_shaper
+from filetolink.admission import admission, admission_middleware
+from filetolink.reaper import reaper
+from filetolink.warmup import cancel_warmup
+from filetolink.links import get_link
 routes = web.RouteTableDef()
 def get_domain(request):
     """Safely detects if running on Render, Heroku, or Localhost in AIOHTTP"""
@@ -326,6 +345,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     </footer>
     <script src="https://cdn.plyr.io/3.7.8/plyr.polyfilled.js"></script>
     <script src="https://cdn.jsdelivr.net/npm/mpegts.js@1.7.3/dist/mpegts.min.js"></script>
+    <script src="https://cdn.jsdelivr.net/npm/hls.js@1.5.15/dist/hls.min.js"></script>
     <script src="https://cdn.jsdelivr.net/gh/Bharathboy/utils@main/jsmkv-polyfill.js"></script>
     <script>
         function initPlayer() {
@@ -334,19 +354,73 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
             const url = "{{STREAM_URL}}";
             const ext = "{{FILE_NAME}}".split('.').pop().toLowerCase();
            
-            if (ext === "mkv" && document.querySelector('script[src*="jsmkv"]')) {
-                video.classList.add("mkv-player");
-                setTimeout(() => initPlyr(video), 100);
+            if (ext === "mkv") {
+                initRemux(video);
             } else if (["flv", "ts"].includes(ext) && typeof mpegts !== "undefined") {
                 initMpegts(video, url);
+            } else if (["mp4", "m4v", "mov"].includes(ext)) {
+                initHls(video).finally(() => setTimeout(() => initPlyr(video), 100));
             } else {
                 setTimeout(() => initPlyr(video), 100);
             }
         }
+        function initRemux(video) {
+            // MKV plays raw first (seekable through Range requests). Only when the browser can't
+            // demux or decode it is it rewritten to fragmented MP4 server-side, which plays front to back
+            const source = video.querySelector("source");
+            let remuxed = false;
+            const toRemux = () => {
+                if (remuxed) return;
+                remuxed = true;
+                source.removeAttribute("src");
+                video.src = "{{REMUX_URL}}";
+                video.load();
+            };
+            source.addEventListener("error", toRemux);
+            video.addEventListener("error", () => { if (!video.src.includes("/remux/")) toRemux(); });
+            video.addEventListener("loadedmetadata", () => { if (video.videoWidth === 0) toRemux(); });
+            addSubtitles(video).finally(() => setTimeout(() => initPlyr(video), 100));
+        }
+        async function addSubtitles(video) {
+            // Soft subtitle tracks of the MKV, extracted server-side as WebVTT
+            try {
+                const res = await fetch("{{SUBS_URL}}");
+                if (!res.ok) return;
+                const data = await res.json();
+                data.tracks.forEach((t, i) => {
+                    const track = document.createElement("track");
+                    track.kind = "subtitles";
+                    track.src = t.url;
+                    track.srclang = t.language;
+                    track.label = t.name || t.language;
+                    track.default = i === 0;
+                    video.appendChild(track);
+                });
+            } catch (err) {}
+        }
+        async function initHls(video) {
+            // Fragmented MP4s get a keyframe-aligned playlist; anything else keeps the raw stream
+            const hlsUrl = "{{HLS_URL}}";
+            try {
+                const res = await fetch(hlsUrl);
+                if (!res.ok) return;
+            } catch (err) {
+                return;
+            }
+            if (video.canPlayType("application/vnd.apple.mpegurl")) {
+                video.src = hlsUrl;
+            } else if (typeof Hls !== "undefined" && Hls.isSupported()) {
+                const hls = new Hls();
+                hls.loadSource(hlsUrl);
+                hls.attachMedia(video);
+                window.hlsPlayer = hls;
+            }
+        }
         function initPlyr(video) {
             if (window.plyrPlayer) return;
             window.plyrPlayer = new Plyr(video, {
-                controls: ["play-large", "play", "progress", "current-time", "mute", "volume", "pip", "fullscreen"],
+                controls: ["play-large", "play", "progress", "current-time", "mute", "volume", "captions", "pip", "fullscreen"],
+                captions: { active: true, update: true },
             });
         }
         function initMpegts(video, url) {
@@ -415,17 +489,23 @@ async def alive(request):
 async def watch_page(request):
     try:
         hash_id = request.match_info['hash_id']
-        link_data = await db.get_link(hash_id)
+        link_data = await get_link(hash_id)
         if not link_data:
             return web.Response(text="<h1>❌ 404 - Link Expired</h1><p>The self-destruct timer has triggered.</p>", content_type='text/html', status=404)
         file_name = link_data.get('file_name') or 'Unknown_Video.mp4'  # Fix: Handle None
         domain = get_domain(request) or 'https://new-repo-sere.onrender.com'  # Fix: Fallback if env var issue
         stream_url = f"{domain}/stream/{hash_id}"
         dl_url = f"{domain}/dl/{hash_id}"
+        hls_url = f"{domain}/hls/{hash_id}/index.m3u8"
+        remux_url = f"{domain}/remux/{hash_id}"
+        subs_url = f"{domain}/subs/{hash_id}"
         # Safely inject the variables (ensure str)
         html = HTML_TEMPLATE.replace('{{FILE_NAME}}', str(file_name)) \
                             .replace('{{STREAM_URL}}', str(stream_url)) \
-                            .replace('{{DL_URL}}', str(dl_url))
+                            .replace('{{DL_URL}}', str(dl_url)) \
+                            .replace('{{HLS_URL}}', str(hls_url)) \
+                            .replace('{{REMUX_URL}}', str(remux_url)) \
+                            .replace('{{SUBS_URL}}', str(subs_url))
         return web.Response(text=html, content_type='text/html')
     except Exception as e:
         logging.error(f"Error in watch_page: {traceback.format_exc()}")
@@ -446,9 +526,59 @@ async def stream_route(request):
     except Exception as e:
         logging.error(f"Error in stream_route: {traceback.format_exc()}")
         return web.Response(text="<h1>500 Internal Server Error</h1><p>Something went wrong.</p>", content_type='text/html', status=500)
+# 🎞️ Route Traffic to hls.py
+@routes.get('/hls/{hash_id}/index.m3u8')
+async def hls_route(request):
+    try:
+        return await handle_hls(request)
+    except Exception as e:
+        logging.error(f"Error in hls_route: {traceback.format_exc()}")
+        return web.Response(text="<h1>500 Internal Server Error</h1><p>Something went wrong.</p>", content_type='text/html', status=500)
+# 🔁 Route Traffic to remux.py
+@routes.get('/remux/{hash_id}')
+async def remux_route(request):
+    try:
+        return await handle_remux(request)
+    except Exception as e:
+        logging.error(f"Error in remux_route: {traceback.format_exc()}")
+        return web.Response(text="<h1>500 Internal Server Error</h1><p>Something went wrong.</p>", content_type='text/html', status=500)
+# 💬 Route Traffic to subs.py
+@routes.get('/subs/{hash_id}')
+async def subs_list_route(request):
+    try:
+        return await handle_subs_list(request)
+    except Exception as e:
+        logging.error(f"Error in subs_list_route: {traceback.format_exc()}")
+        return web.Response(text="<h1>500 Internal Server Error</h1><p>Something went wrong.</p>", content_type='text/html', status=500)
+@routes.get(r'/subs/{hash_id}/{track:\d+}.vtt')
+async def subs_route(request):
+    try:
+        return await handle_subs(request)
+    except Exception as e:
+        logging.error(f"Error in subs_route: {traceback.format_exc()}")
+        return web.Response(text="<h1>500 Internal Server Error</h1><p>Something went wrong.</p>", content_type='text/html', status=500)
+# 📊 Streaming Telemetry (cache sizing etc.)
+@routes.get('/api/stats')
+async def stats_route(request):
+    return web.json_response({
+        "link_cache": db.link_cache.stats(),
+        "chunk_cache": chunk_cache.stats(),
+        "inflight": inflight.stats(),
+        "disk_cache": disk_cache.stats(),
+        "media_sessions": get_fetcher(pyro_client).pool.stats(),
+        "clients": get_client_pool(pyro_client).stats(),
+        "stream_budget": stream_budget.stats(),
+        "fetch_scheduler": fetch_scheduler.stats(),
+        "hedging": hedger.stats(),
+        "ttfb": ttfb_stats.stats(),
+        "shaper": bandwidth_shaper.stats(),
+        "admission": admission.stats(),
+        "reaper": reaper.stats(),
+    })
 # ⚙️ Start the Server
 async def start_web_server():
-    app = web.Application()
+    # 🚦 Admission control in front of every streaming route
+    app = web.Application(middlewares=[admission_middleware])
     app.add_routes(routes)
     # 👇 ADD YOUR STARTUP & CLEANUP HOOKS HERE 👇
     async def on_startup(app):
@@ -456,10 +586,25 @@ async def start_web_server():
             if not pyro_client.is_connected:
                 await pyro_client.start()
                 logging.info("✅ Pyrogram Client Started via Web Server")
+            # 🔌 Log in helper bots and open media sessions before the first viewer needs them
+            app['session_warmer'] = asyncio.create_task(get_client_pool(pyro_client).start(secret.PREWARM_DCS))
         except Exception as e:
             logging.error(f"Failed to start Pyrogram: {e}")
+        if disk_cache.enabled:
+            disk_cache.reset()
+            app['disk_sweeper'] = asyncio.create_task(disk_cache.run_sweeper())
+        # 🪓 Close streams whose clients stalled or crawl, so their buffers and fetches go to live viewers
+        app['reaper'] = asyncio.create_task(reaper.run())
     async def on_cleanup(app):
+        if 'session_warmer' in app:
+            app['session_warmer'].cancel()
+        if 'disk_sweeper' in app:
+            app['disk_sweeper'].cancel()
+        if 'reaper' in app:
+            app['reaper'].cancel()
+        cancel_warmup()
         try:
+            await get_client_pool(pyro_client).stop()
             if pyro_client.is_connected:
                 await pyro_client.stop()
                 logging.info("🛑 Pyrogram Client gracefully stopped")
@@ -468,7 +613,8 @@ async def start_web_server():
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
     # 👆 ===================================== 👆
-    runner = web.AppRunner(app)
+    # ✂️ Cancel a handler the moment its client disconnects, not at its next failed write
+    runner = web.AppRunner(app, handler_cancellation=True)
     await runner.setup()
     
     port = int(os.environ.get("PORT", 8080))
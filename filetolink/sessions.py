@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from pyrogram import raw
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session import Auth, Session
+logger = logging.getLogger(__name__)
+class _PooledSession:
+    __slots__ = ("session", "inflight")
+
+    def __init__(self, session):
+        self.session = session
+        self.inflight = 0
+class MediaSessionPool:
+    """
+    Several authorized media connections per DC for one Pyrogram client.
+
+    The auth key (and, for foreign DCs, the exported bot authorization) is
+    created once per DC and shared by every connection in that DC's pool.
+    Pools are filled at startup via prewarm() or in the background the first
+    time a DC is seen, and each lease goes to the least busy connection so
+    concurrent streams don't queue behind a single socket.
+    """
+    def __init__(self, client, size):
+        self.client = client
+        self.size = max(1, size)
+        self._pools = {}  # dc_id -> [_PooledSession]
+        self._auth_keys = {}
+        self._locks = {}
+        self._warming = {}  # dc_id -> background fill task
+        self.opened = 0
+        self.failures = 0
+
+    def _lock(self, dc_id):
+        return self._locks.setdefault(dc_id, asyncio.Lock())
+
+    async def _auth_key(self, dc_id):
+        key = self._auth_keys.get(dc_id)
+        if key is not None:
+            return key, False
+        if dc_id == await self.client.storage.dc_id():
+            key = await self.client.storage.auth_key()
+            self._auth_keys[dc_id] = key
+            return key, False
+        test_mode = await self.client.storage.test_mode()
+        return await Auth(self.client, dc_id, test_mode).create(), True
+
+    async def _open(self, dc_id):
+        client = self.client
+        auth_key, needs_import = await self._auth_key(dc_id)
+        session = Session(client, dc_id, auth_key, await client.storage.test_mode(), is_media=True)
+        await session.start()
+        if needs_import:
+            # Foreign DC: bind the fresh key to our bot once, then share it
+            for _ in range(6):
+                exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+                    break
+                except AuthBytesInvalid:
+                    continue
+            else:
+                await session.stop()
+                raise AuthBytesInvalid
+            self._auth_keys[dc_id] = auth_key
+        self.opened += 1
+        return _PooledSession(session)
+
+    async def _grow(self, dc_id, target):
+        async with self._lock(dc_id):
+            pool = self._pools.setdefault(dc_id, [])
+            while len(pool) < target:
+                try:
+                    pool.append(await self._open(dc_id))
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning(f"Media session for DC {dc_id} failed: {e}")
+                    if not pool:
+                        raise
+                    break
+        return pool
+
+    async def warm(self, dc_id):
+        pool = await self._grow(dc_id, self.size)
+        logger.info(f"🔌 DC {dc_id}: {len(pool)} media sessions warm")
+
+    def warm_in_background(self, dc_id):
+        task = self._warming.get(dc_id)
+        if task is None or task.done():
+            self._warming[dc_id] = asyncio.create_task(self.warm(dc_id))
+
+    async def prewarm(self, dc_ids=()):
+        """Open the full pool for the home DC plus any DCs listed up front."""
+        home = await self.client.storage.dc_id()
+        for dc_id in dict.fromkeys([home, *dc_ids]):
+            try:
+                await self.warm(dc_id)
+            except Exception as e:
+                logger.warning(f"Pre-warm of DC {dc_id} failed: {e}")
+
+    @asynccontextmanager
+    async def lease(self, dc_id, avoid=None):
+        """The least busy session of the DC, other than `avoid` when there is a choice."""
+        pool = self._pools.get(dc_id)
+        if not pool:
+            # First sight of this DC: one session now, the rest in the background
+            pool = await self._grow(dc_id, 1)
+        if len(pool) < self.size:
+            self.warm_in_background(dc_id)
+        entry = min((e for e in pool if e.session is not avoid), key=lambda e: e.inflight, default=None) or pool[0]
+        entry.inflight += 1
+        try:
+            yield entry.session
+        finally:
+            entry.inflight -= 1
+
+    async def discard(self, dc_id, session):
+        """Throw away a broken connection; the pool refills on next lease."""
+        pool = self._pools.get(dc_id, [])
+        for entry in pool:
+            if entry.session is session:
+                pool.remove(entry)
+                break
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
+    async def close(self):
+        for task in self._warming.values():
+            task.cancel()
+        for dc_id, pool in self._pools.items():
+            for entry in pool:
+                try:
+                    await entry.session.stop()
+                except Exception:
+                    pass
+        self._pools.clear()
+
+    def stats(self):
+        return {
+            "opened": self.opened,
+            "failures": self.failures,
+            "dcs": {
+                str(dc_id): {"sessions": len(pool), "inflight": sum(e.inflight for e in pool)}
+                for dc_id, pool in self._pools.items()
+            },
+        }
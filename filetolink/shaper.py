@@ -0,0 +1,203 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import Counter
+import secret
+from database.db import db
+logger = logging.getLogger(__name__)
+MB = 1024 * 1024
+MBIT = 125000  # Bytes per second in one megabit per second
+TIER_TTL = 300  # Seconds an owner's premium status is trusted before asking Mongo again
+def client_ip(request):
+    """
+    The viewer's address, through Render's / Heroku's proxy when there is one.
+
+    Entries left of what our own TRUSTED_PROXIES appended are whatever the
+    client sent, so the address is taken counting from the right: a forged
+    X-Forwarded-For can't dodge the per-IP caps or split a swarm's share.
+    """
+    if secret.TRUSTED_PROXIES:
+        hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+        if len(hops) >= secret.TRUSTED_PROXIES:
+            return hops[-secret.TRUSTED_PROXIES]
+    return request.remote or "unknown"
+class TokenBucket:
+    """Bytes/s limiter: a write may overdraw it, the next one waits the debt off."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._stamp = None
+
+    def refill(self, now):
+        if self._stamp is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def take(self, nbytes):
+        self.refill(asyncio.get_running_loop().time())
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+class Flow:
+    """One response's share of the uplink, and its progress for the slow-client reaper."""
+    def __init__(self, shaper, group, premium, transport):
+        self.shaper = shaper
+        self.group = group  # (link, client ip): parallel connections split one share
+        self.premium = premium
+        self.transport = transport
+        self.weight = secret.PREMIUM_WEIGHT if premium else 1.0
+        cap = (secret.PREMIUM_CONN_MBPS if premium else secret.FREE_CONN_MBPS) * MBIT
+        self.bucket = TokenBucket(cap, max(256 * 1024, cap / 4)) if cap else None
+        self.finish = 0.0  # Virtual finish time of this flow's last write
+        self.closed = False
+        self.opened_at = self.progress_at = asyncio.get_running_loop().time()
+        self.sent = 0
+        self.blocked = 0.0  # Seconds spent inside writes, i.e. waiting on the client
+
+    async def pace(self, nbytes):
+        """Wait until `nbytes` more may go out on this connection."""
+        if self.bucket:
+            await self.bucket.take(nbytes)
+        await self.shaper.admit(self, nbytes)
+
+    async def send(self, nbytes, write):
+        """
+        Pace, then await `write()` (which puts `nbytes` on the wire) within
+        WRITE_TIMEOUT_SECONDS. A client that stops reading raises TimeoutError
+        and has its connection closed.
+        """
+        await self.pace(nbytes)
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        try:
+            await asyncio.wait_for(write(), secret.WRITE_TIMEOUT_SECONDS or None)
+        except asyncio.TimeoutError:
+            self.abort()
+            raise
+        finally:
+            self.blocked += loop.time() - began
+        self.sent += nbytes
+        self.progress_at = loop.time()
+
+    def abort(self):
+        """Drop the connection: aiohttp cancels the handler, which cancels its fetches."""
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shaper.release(self)
+class BandwidthShaper:
+    """
+    Weighted fair queuing of response writes under a global egress ceiling.
+
+    Every /stream, /dl and /remux write asks here before it goes out. While
+    the uplink has tokens to spare writes pass straight through; once it is
+    saturated they are released in virtual-finish-time order (self-clocked
+    fair queuing), so each flow gets bandwidth in proportion to its weight:
+    the link owner's tier, divided among the parallel connections a client
+    has open to the same link. A download manager with 16 connections thus
+    gets one viewer's share, not sixteen. Each flow may also be capped by
+    its own per-tier token bucket.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # Bytes/s, 0 = no global ceiling (per-flow caps still apply)
+        self.bucket = TokenBucket(rate, burst or max(MB, rate / 10)) if rate else None
+        self._heap = []  # (finish, seq, nbytes, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._vtime = 0.0
+        self._groups = Counter()
+        self.flows = set()  # Open flows, walked by the slow-client reaper
+        self._tiers = {}  # owner id -> (premium, checked at)
+        self.sent = {"premium": 0, "free": 0}
+        self.queued = 0
+        self.waited = 0.0
+
+    async def tier_of(self, link):
+        """The link owner's current premium status (cached), else the one stored at creation."""
+        owner = link.get("owner_id")
+        if owner is None:
+            return bool(link.get("premium", False))
+        cached = self._tiers.get(owner)
+        if cached and time.time() - cached[1] < TIER_TTL:
+            return cached[0]
+        try:
+            premium = await db.check_premium_status(owner)
+        except Exception as e:
+            logger.warning(f"Tier lookup for {owner} failed: {e}")
+            premium = bool(link.get("premium", False))
+        self._tiers[owner] = (premium, time.time())
+        if len(self._tiers) > 4096:
+            self._tiers.pop(next(iter(self._tiers)))
+        return premium
+
+    async def open(self, request, link):
+        """A Flow for one response; close() it when the response is done."""
+        group = (link["_id"], client_ip(request))
+        premium = await self.tier_of(link)
+        flow = Flow(self, group, premium, request.transport)
+        self._groups[group] += 1
+        self.flows.add(flow)
+        return flow
+
+    def release(self, flow):
+        self.flows.discard(flow)
+        self._groups[flow.group] -= 1
+        if self._groups[flow.group] <= 0:
+            del self._groups[flow.group]
+
+    async def admit(self, flow, nbytes):
+        self.sent["premium" if flow.premium else "free"] += nbytes
+        if self.bucket is None:
+            return
+        loop = asyncio.get_running_loop()
+        share = flow.weight / max(1, self._groups[flow.group])
+        flow.finish = max(self._vtime, flow.finish) + nbytes / share
+        if not self._heap:
+            self.bucket.refill(loop.time())
+            if self.bucket.tokens >= 0:
+                self.bucket.tokens -= nbytes
+                self._vtime = flow.finish
+                return
+        fut = loop.create_future()
+        heapq.heappush(self._heap, (flow.finish, next(self._seq), nbytes, fut))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self.queued += 1
+        started = loop.time()
+        try:
+            await fut
+        finally:
+            self.waited += loop.time() - started
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            self.bucket.refill(loop.time())
+            if self.bucket.tokens < 0:
+                await asyncio.sleep(-self.bucket.tokens / self.rate)
+                continue
+            finish, _, nbytes, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue  # Writer was cancelled (client left)
+            self.bucket.tokens -= nbytes
+            self._vtime = finish
+            fut.set_result(None)
+
+    def stats(self):
+        return {
+            "egress_limit_mbps": round(self.rate / MBIT, 1),
+            "flows": len(self.flows),
+            "clients": len(self._groups),
+            "waiting": sum(1 for entry in self._heap if not entry[-1].done()),
+            "sent_bytes": dict(self.sent),
+            "queued_writes": self.queued,
+            "avg_queue_ms": round(self.waited / self.queued * 1000, 1) if self.queued else 0.0,
+        }
+# 🚰 One shaper for every response the web tier sends
+bandwidth_shaper = BandwidthShaper(secret.EGRESS_LIMIT_MBPS * MBIT)
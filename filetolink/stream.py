@@ -1,4 +1,3 @@
-import re
 import logging
 import random
 import asyncio
@@ -7,8 +6,17 @@ import aiohttp_jinja2
 from aiohttp import web
 from pyrogram import Client
 import secret
-from database.db import db
-from filetolink.fast import TurboStreamer
+from database.db import seconds_left
+from filetolink.fast import TurboStreamer, readahead_window
+from filetolink.disk_cache import disk_cache
+from filetolink.budget import stream_budget
+from filetolink.ranges import plan_ranges, file_etag
+from filetolink.media import resolve_media
+from filetolink.links import get_link
+from filetolink.ttfb import ttfb_stats
+from filetolink.container import schedule_index_pin
+from filetolink.seek import keyframe_at
+from filetolink.shaper import bandwidth_shaper
 logger = logging.getLogger(__name__)
 # Global Client setup with high worker pool for parallel fetching
 pyro_client = Client(
@@ -25,7 +33,7 @@ pyro_client = Client(
 async def watch_page(request):
     try:
         hash_id = request.match_info.get('hash_id')
-        link_data = await db.get_link(hash_id)
+        link_data = await get_link(hash_id)
         
         if not link_data:
             return web.Response(text="❌ Link Expired or Invalid", status=404)
@@ -40,63 +48,74 @@ async def watch_page(request):
         logger.error(f"Watch Page Error: {traceback.format_exc()}")
         return web.Response(text="❌ 500 - Internal Server Error", status=500)
 async def handle_stream(request: web.Request):
+    started = asyncio.get_running_loop().time()  # For the TTFB report
     hash_id = request.match_info.get('hash_id')
-    link_data = await db.get_link(hash_id)
+    link_data = await get_link(hash_id)
     if not link_data:
         return web.Response(text="❌ 404 - Link Expired", status=404)
     try:
-        message = await pyro_client.get_messages(link_data['chat_id'], link_data['message_id'])
-        media = getattr(message, "document", None) or getattr(message, "video", None) or getattr(message, "audio", None)
+        # 🎞️ Straight from the stored descriptor (no get_messages per range request)
+        media = await resolve_media(pyro_client, link_data['_id'], link_data)
         if not media:
             return web.Response(text="❌ Media not found", status=404)
-        file_size = int(getattr(media, 'file_size', 0))
-        filename = link_data.get('file_name') or getattr(media, 'file_name', 'video.mp4')  # Fix: Handle None
-        mime_type = getattr(media, "mime_type", "video/mp4")
-        offset = 0
-        limit = file_size - 1
-        range_header = request.headers.get('Range')
-        status_code = 200
-        if range_header:
-            m = re.match(r"bytes=(\d+)-(\d*)", range_header)
-            if m:
-                offset = int(m.group(1))
-                if m.group(2):
-                    limit = int(m.group(2))
-                status_code = 206
-        # Clamp limit to file size
-        if limit >= file_size:
-            limit = file_size - 1
-        req_length = limit - offset + 1
-        headers = {
-            "Content-Type": mime_type,
-            "Accept-Ranges": "bytes",
-            "Content-Length": str(req_length),
-            "Content-Range": f"bytes {offset}-{limit}/{file_size}",
-            "Content-Disposition": f'inline; filename="{filename}"',
-            "Cache-Control": "public, max-age=31536000", # 🔥 Cache it forever
-        }
+        # 📌 Find and pin the container index (moov / Cues) once per file, in the background
+        schedule_index_pin(pyro_client, media, link_data)
+        file_size = media.file_size
+        filename = link_data.get('file_name') or media.file_name or 'video.mp4'  # Fix: Handle None
+        mime_type = media.mime_type or "video/mp4"
+        # ⏩ ?t=<seconds>: start at the keyframe before that time. Only without a Range:
+        # a 206 for bytes the client didn't ask for (even for `bytes=0-`) breaks Chromium
+        keyframe = None
+        if "t" in request.query and "Range" not in request.headers:
+            try:
+                seconds = float(request.query["t"])
+                if not 0 <= seconds < 1e7:
+                    raise ValueError(seconds)
+            except ValueError:
+                return web.Response(text="❌ Bad seek time", status=400)
+            keyframe = await keyframe_at(pyro_client, media, seconds_left(link_data), seconds)
+        # 🎯 Shared range + conditional layer (suffix / multi-range, 416, ETag / 304)
+        plan = plan_ranges(request, file_size, file_etag(media.file_unique_id or media.message_id, file_size), keyframe and keyframe[1])
+        if isinstance(plan, web.Response):
+            return plan
+        headers = plan.headers(mime_type)
+        if keyframe:
+            headers["X-Keyframe-Time"] = f"{keyframe[0]:.3f}"
+        headers["Content-Disposition"] = f'inline; filename="{filename}"'
+        headers["Cache-Control"] = "public, max-age=31536000" # 🔥 Cache it forever
         if request.method == "HEAD":
-            return web.Response(status=status_code, headers=headers)
-        response = web.StreamResponse(status=status_code, headers=headers)
+            return web.Response(status=plan.status, headers=headers)
+        response = web.StreamResponse(status=plan.status, headers=headers)
         response.enable_compression(False)
         await response.prepare(request)
-        # On Render free tier, use 1 worker for streaming to save resources
-        streamer = TurboStreamer(
-            pyro_client,
-            message,
-            offset_bytes=offset,
-            limit_bytes=limit,
-            workers=1
-        )
-        async for chunk in streamer.generate():
+        # 🚰 Paced by the shaper: fair share by the owner's tier under the egress ceiling
+        flow = await bandwidth_shaper.open(request, link_data)
+        try:
+            # 💽 Span already on disk? Let the kernel push it (sendfile)
+            if len(plan.ranges) == 1 and await disk_cache.sendfile(request, response, media.key, *plan.ranges[0], flow=flow):
+                return response
+            def open_stream(start, end):
+                # 🧠 Parallel fetchers granted from the global stream memory budget
+                streamer = TurboStreamer(
+                    pyro_client,
+                    media,
+                    offset_bytes=start,
+                    limit_bytes=end,
+                    workers=stream_budget.grant("stream") if end - start >= 1024 * 1024 else 1,
+                    readahead_bytes=readahead_window("stream", file_size, media.duration),
+                    kind="stream",
+                    premium=link_data.get("premium", False)
+                )
+                return streamer.generate()
+            await plan.write_body(response, mime_type, open_stream, flow)
+            if plan.first_byte_at is not None:
+                ttfb_stats.record("stream", plan.first_byte_at - started, f"bytes={plan.ranges[0][0]}-{plan.ranges[-1][1]}")
             try:
-                await response.write(chunk)
+                await response.write_eof()
             except Exception:
-                break
-        try:
-            await response.write_eof()
-        except Exception:
-            pass
+                pass
+        finally:
+            flow.close()
            
         return response
     except Exception as e:
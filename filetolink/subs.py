@@ -0,0 +1,269 @@
+import re
+import html
+import zlib
+import asyncio
+import logging
+from collections import OrderedDict
+from aiohttp import web
+from database.db import seconds_left
+from filetolink.stream import pyro_client
+from filetolink.fast import TurboStreamer
+from filetolink.media import resolve_media
+from filetolink.links import get_link
+from filetolink.scheduler import fetch_priority
+from filetolink.container import read_index, element_header, track_cues, on_index_reset, MKV_TIMECODE_SCALE
+from filetolink.remux import (
+    EbmlReader, UnsupportedMedia, read_head, iter_blocks, block_frames, children,
+    MKV_TRACK_ENTRY, MKV_TRACK_NUMBER, MKV_TRACK_TYPE, MKV_CODEC_ID, MKV_CONTENT_ENCODINGS,
+    MKV_BLOCK, MKV_BLOCK_GROUP, MKV_SIMPLE_BLOCK,
+)
+logger = logging.getLogger(__name__)
+# 💬 Soft subtitles out of an MKV as WebVTT: with mkvmerge-style Cues every
+# subtitle block is one small aligned read, without relative positions only
+# the cued clusters are read (up to SCAN_LIMIT), once per file. Files with
+# no Cues for the track would need a whole-file walk and get a 404 instead
+SUBTITLE_CODECS = {"S_TEXT/UTF8": "srt", "S_TEXT/ASS": "ass", "S_TEXT/SSA": "ass", "S_TEXT/WEBVTT": "vtt"}
+MKV_LANGUAGE = 0x22B59C
+MKV_NAME = 0x536E
+MKV_BLOCK_DURATION = 0x9B
+MKV_CONTENT_ENCODING = 0x6240
+MKV_CONTENT_COMPRESSION = 0x5034
+MKV_CONTENT_COMP_ALGO = 0x4254
+MKV_CONTENT_COMP_SETTINGS = 0x4255
+PEEK_BYTES = 4096  # One GetFile part: holds the header and text of a typical subtitle block
+PEEK_CONCURRENCY = 8
+DEFAULT_CUE_MS = 4000  # Events with no duration last until the next one, at most this long
+SCAN_LIMIT = 64 * 1024 * 1024  # Most bytes a cluster scan may pull before giving up on the track
+_heads = OrderedDict()  # media key -> {"segment", "scale", "cluster_at", "tracks"} or None (not an MKV)
+_vtt = OrderedDict()  # (media key, track) -> WebVTT text
+_building = {}  # (media key, track) -> task, so concurrent viewers share one extraction
+def _reset():
+    for task in _building.values():
+        task.cancel()
+    _building.clear()
+    _heads.clear()
+    _vtt.clear()
+on_index_reset(_reset)
+def _decoder(fields):
+    """Frame decoder for a track's ContentEncodings (zlib / header stripping), None if unsupported."""
+    if MKV_CONTENT_ENCODINGS not in fields:
+        return lambda frame: frame
+    encodings = dict(children(fields[MKV_CONTENT_ENCODINGS]))
+    encoding = dict(children(encodings.get(MKV_CONTENT_ENCODING, b"")))
+    if MKV_CONTENT_COMPRESSION not in encoding:
+        return None  # Encrypted
+    compression = dict(children(encoding[MKV_CONTENT_COMPRESSION]))
+    algo = int.from_bytes(compression.get(MKV_CONTENT_COMP_ALGO, b""), "big")
+    if algo == 0:
+        return zlib.decompress
+    if algo == 3:
+        prefix = compression.get(MKV_CONTENT_COMP_SETTINGS, b"")
+        return lambda frame: prefix + frame
+    return None
+def subtitle_tracks(tracks_body):
+    """{track number: {...}} for the text subtitle tracks of an MKV."""
+    found = {}
+    for element_id, entry in children(tracks_body):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        fields = dict(children(entry))
+        codec = fields.get(MKV_CODEC_ID, b"").rstrip(b"\0").decode("ascii", "replace")
+        decode = _decoder(fields)
+        if int.from_bytes(fields.get(MKV_TRACK_TYPE, b""), "big") != 0x11 or codec not in SUBTITLE_CODECS or not decode:
+            continue
+        number = int.from_bytes(fields.get(MKV_TRACK_NUMBER, b""), "big")
+        found[number] = {
+            "track": number,
+            "format": SUBTITLE_CODECS[codec],
+            "language": fields.get(MKV_LANGUAGE, b"eng").rstrip(b"\0").decode("utf-8", "replace"),
+            "name": fields.get(MKV_NAME, b"").decode("utf-8", "replace"),
+            "decode": decode,
+        }
+    return found
+# ================= TEXT =================
+_ASS_OVERRIDE = re.compile(r"\{[^}]*\}")
+_ASS_STYLE = re.compile(r"\\([ibu])([01])")
+def ass_text(line):
+    """Dialogue text of an MKV ASS/SSA block, override tags dropped (italic / bold / underline kept)."""
+    text = line.split(",", 8)[-1]
+    if re.search(r"\\p[1-9]", text):
+        return ""  # Vector drawing, not text
+    def override(match):
+        return "".join(f"<{tag}>" if on == "1" else f"</{tag}>" for tag, on in _ASS_STYLE.findall(match.group(0)))
+    text = _ASS_OVERRIDE.sub(override, html.escape(text, quote=False))
+    return text.replace("\\N", "\n").replace("\\n", "\n").replace("\\h", " ").strip()
+def srt_text(text):
+    """SRT text with the tags WebVTT knows (i / b / u) kept and the rest escaped or dropped."""
+    text = html.escape(text.replace("\r\n", "\n").strip(), quote=False)
+    text = re.sub(r"&lt;(/?)([ibu])&gt;", lambda m: f"<{m.group(1)}{m.group(2).lower()}>", text, flags=re.I)
+    return re.sub(r"&lt;/?font[^&]*&gt;", "", text, flags=re.I)
+def vtt_stamp(ms):
+    ms = max(int(round(ms)), 0)
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+def to_vtt(events, track, scale):
+    """WebVTT document from (timecode, duration or None, [frames]) events."""
+    convert = {"srt": srt_text, "ass": ass_text, "vtt": srt_text}[track["format"]]
+    events.sort(key=lambda e: e[0])
+    cues = []
+    for i, (time, duration, frames) in enumerate(events):
+        start = time * scale / 1e6
+        if duration:
+            end = start + duration * scale / 1e6
+        else:
+            following = events[i + 1][0] * scale / 1e6 if i + 1 < len(events) else start + DEFAULT_CUE_MS
+            end = min(following, start + DEFAULT_CUE_MS)
+        text = "\n".join(filter(None, (convert(track["decode"](frame).decode("utf-8", "replace")) for frame in frames)))
+        if text:
+            cues.append(f"{vtt_stamp(start)} --> {vtt_stamp(end)}\n{text}")
+    return "WEBVTT\n\n" + "\n\n".join(cues) + "\n"
+# ================= EXTRACTION =================
+def _streamer(media, offset=0, premium=False):
+    return TurboStreamer(pyro_client, media, offset, media.file_size - 1, readahead_bytes=1024 * 1024, premium=premium)
+async def load_head(media, premium=False):
+    """Segment offset, timecode scale and subtitle tracks of an MKV (None otherwise), cached per file."""
+    if media.key in _heads:
+        return _heads[media.key]
+    reader = EbmlReader(lambda offset: _streamer(media, offset, premium).generate())
+    try:
+        found = await read_head(reader)
+        info = dict(children(found["info"]))
+        head = {
+            "segment": found["segment"],
+            "scale": int.from_bytes(info.get(MKV_TIMECODE_SCALE, b""), "big") or 1000000,
+            "cluster_at": found["cluster"][2],
+            "tracks": subtitle_tracks(found["tracks"]),
+        }
+    except (UnsupportedMedia, ValueError, IndexError, EOFError):
+        head = None
+    finally:
+        await reader.close()
+    _heads[media.key] = head
+    if len(_heads) > 1024:
+        _heads.popitem(last=False)
+    return head
+async def cued_events(media, cues, track, priority):
+    """Subtitle events read block by block at the positions the Cues give."""
+    streamer = _streamer(media)
+    data_starts = {}  # cluster offset -> offset of its first child
+    limit = asyncio.Semaphore(PEEK_CONCURRENCY)
+    async def event(time, cluster_at, relative, duration):
+        async with limit:
+            if cluster_at not in data_starts:
+                data_starts[cluster_at] = cluster_at + element_header(await streamer.peek(cluster_at, 16, priority))[1]
+            at = data_starts[cluster_at] + relative
+            data = await streamer.peek(at, PEEK_BYTES, priority)
+            element_id, header_len, size = element_header(data)
+            if header_len + size > len(data):
+                data += await streamer.peek(at + len(data), header_len + size - len(data), priority)
+            body = data[header_len:header_len + size]
+        if element_id == MKV_BLOCK_GROUP:
+            group = dict(children(body))
+            block = group.get(MKV_BLOCK, b"")
+            if MKV_BLOCK_DURATION in group:
+                duration = int.from_bytes(group[MKV_BLOCK_DURATION], "big")
+        elif element_id == MKV_SIMPLE_BLOCK:
+            block = body
+        else:
+            return None
+        number, _, _, frames = block_frames(block)
+        return (time, duration, frames) if number == track else None
+    results = await asyncio.gather(*(event(*cue) for cue in cues))
+    return [result for result in results if result]
+async def scanned_events(media, track, clusters, premium):
+    """Subtitle events read from the cued `clusters` only, jumping straight to each one."""
+    reader = EbmlReader(lambda offset: _streamer(media, offset, premium).generate())
+    events = []
+    try:
+        for cluster_at in sorted(clusters):
+            if cluster_at < reader.pos:
+                continue  # Inside the cluster just read (bad Cues)
+            await reader.seek(cluster_at)
+            async for cluster_time, block, group in iter_blocks(reader, None, {cluster_at}, only_track=track, single_cluster=True):
+                number, relative, _, frames = block_frames(block)
+                if number != track:
+                    continue
+                duration = None
+                if group and MKV_BLOCK_DURATION in group:
+                    duration = int.from_bytes(group[MKV_BLOCK_DURATION], "big")
+                events.append((cluster_time + relative, duration, frames))
+            if reader.fetched > SCAN_LIMIT:
+                raise UnsupportedMedia(f"subtitle clusters need more than {SCAN_LIMIT // (1024 * 1024)} MB of reads")
+    finally:
+        await reader.close()
+    return events
+async def build_vtt(media, link_data, head, number):
+    ttl = seconds_left(link_data)
+    premium = link_data.get("premium", False)
+    priority = fetch_priority("stream", False, premium)
+    cues = []
+    entries = await read_index(pyro_client, media, ttl)
+    if entries:
+        cues = track_cues(entries[0][1], head["segment"], number)
+    if not cues:
+        raise UnsupportedMedia("no Cues for this track, extracting it means reading the whole file")
+    if all(cue[2] is not None for cue in cues):
+        events = await cued_events(media, cues, number, priority)
+        how = f"{len(cues)} cued blocks"
+    else:
+        clusters = {cue[1] for cue in cues}
+        events = await scanned_events(media, number, clusters, premium)
+        how = f"{len(clusters)} cued clusters"
+    logger.info(f"💬 Subtitles {media.key} track {number}: {len(events)} events from {how}")
+    return to_vtt(events, head["tracks"][number], head["scale"])
+def _built(key, task):
+    """Keep a finished extraction whether or not anyone is still waiting for it."""
+    if _building.get(key) is task:
+        del _building[key]
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        if not isinstance(error, UnsupportedMedia):
+            logger.warning(f"💬 Subtitle extraction {key} failed: {error!r}")
+        return
+    _vtt[key] = task.result()
+    if len(_vtt) > 256:
+        _vtt.popitem(last=False)
+async def handle_subs_list(request: web.Request):
+    hash_id = request.match_info.get('hash_id')
+    link_data = await get_link(hash_id)
+    if not link_data:
+        return web.Response(text="❌ 404 - Link Expired", status=404)
+    media = await resolve_media(pyro_client, link_data['_id'], link_data)
+    if not media:
+        return web.Response(text="❌ Media not found", status=404)
+    head = await load_head(media, link_data.get("premium", False))
+    tracks = [
+        {key: value for key, value in track.items() if key != "decode"} | {"url": f"/subs/{hash_id}/{number}.vtt"}
+        for number, track in (head["tracks"].items() if head else [])
+    ]
+    return web.json_response({"tracks": tracks}, headers={"Cache-Control": "private, max-age=300"})
+async def handle_subs(request: web.Request):
+    hash_id = request.match_info.get('hash_id')
+    number = int(request.match_info.get('track'))
+    link_data = await get_link(hash_id)
+    if not link_data:
+        return web.Response(text="❌ 404 - Link Expired", status=404)
+    media = await resolve_media(pyro_client, link_data['_id'], link_data)
+    if not media:
+        return web.Response(text="❌ Media not found", status=404)
+    key = (media.key, number)
+    text = _vtt.get(key)
+    if text is None:
+        head = await load_head(media, link_data.get("premium", False))
+        if not head or number not in head["tracks"]:
+            return web.Response(text="❌ No text subtitle track with that number", status=404)
+        task = _building.get(key)
+        if task is None:
+            task = _building[key] = asyncio.create_task(build_vtt(media, link_data, head, number))
+            task.add_done_callback(lambda t: _built(key, t))
+        # Shielded: a viewer closing the page doesn't waste an extraction, _built() keeps it
+        try:
+            text = await asyncio.shield(task)
+        except UnsupportedMedia as e:
+            return web.Response(text=f"❌ Can't extract these subtitles ({e})", status=404)
+        except asyncio.CancelledError:
+            if not task.cancelled() or asyncio.current_task().cancelling():
+                raise  # This viewer left
+            return web.Response(text="❌ Subtitle extraction was reset, retry", status=503, headers={"Retry-After": "1"})
+    return web.Response(text=text, content_type="text/vtt", charset="utf-8", headers={"Cache-Control": "private, max-age=3600"})
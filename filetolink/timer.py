@@ -1,5 +1,9 @@
 # timer.py — secure, timezone-safe token & expiry helpers
 from __future__ import annotations
+import hmac
+import struct
+import base64
+import hashlib
 import secrets
 import datetime
 from typing import Optional
@@ -75,3 +79,67 @@ def iso_to_expiry(s: str) -> datetime.datetime:
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=UTC)
     return dt
+
+
+# ================= STATELESS SIGNED LINKS =================
+# Token = base64url(payload || HMAC-SHA256(payload)[:16]); payload layout:
+# version, chat_id, message_id, size, expires (unix), issued (unix), link_id
+_TOKEN_VERSION = 1
+_TOKEN_STRUCT = struct.Struct(">BqIQII12s")
+_MAC_LEN = 16
+
+
+def sign_link_token(key: bytes, link_id: str, chat_id: int, message_id: int,
+                    size: int, expires_at: datetime.datetime,
+                    issued_at: Optional[datetime.datetime] = None) -> str:
+    """
+    Encode a link as a compact HMAC-signed token that can be verified
+    without a database. `link_id` (a 12-char `generate_hash()`) ties the
+    token to its audit record in `file_links`.
+    """
+    if expires_at.tzinfo is None:
+        raise ValueError("expiry must be timezone-aware")
+    link_bytes = link_id.encode()
+    if len(link_bytes) != 12:
+        raise ValueError("link_id must be 12 characters")
+    issued_at = issued_at or datetime.datetime.now(UTC)
+    payload = _TOKEN_STRUCT.pack(
+        _TOKEN_VERSION, chat_id, message_id, size,
+        int(expires_at.timestamp()), int(issued_at.timestamp()), link_bytes,
+    )
+    mac = hmac.new(key, payload, hashlib.sha256).digest()[:_MAC_LEN]
+    return base64.urlsafe_b64encode(payload + mac).decode().rstrip("=")
+
+
+def verify_link_token(key: bytes, token: str,
+                      now: Optional[datetime.datetime] = None) -> Optional[dict]:
+    """
+    Return the token's claims if the signature is valid and it has not
+    expired, else None. Revocation is the caller's job (see `issued_at`).
+    """
+    expected_len = _TOKEN_STRUCT.size + _MAC_LEN
+    if not key or len(token) != (expected_len * 4 + 2) // 3:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return None
+    if len(raw) != expected_len:
+        return None
+    payload, mac = raw[:_TOKEN_STRUCT.size], raw[_TOKEN_STRUCT.size:]
+    if not hmac.compare_digest(mac, hmac.new(key, payload, hashlib.sha256).digest()[:_MAC_LEN]):
+        return None
+    version, chat_id, message_id, size, expires, issued, link_id = _TOKEN_STRUCT.unpack(payload)
+    if version != _TOKEN_VERSION:
+        return None
+    expires_at = datetime.datetime.fromtimestamp(expires, UTC)
+    if is_expired(expires_at, now):
+        return None
+    return {
+        "link_id": link_id.decode(),
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "size": size,
+        "expires_at": expires_at,
+        "issued_at": datetime.datetime.fromtimestamp(issued, UTC),
+    }
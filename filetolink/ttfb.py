@@ -0,0 +1,24 @@
+import logging
+from collections import deque
+logger = logging.getLogger(__name__)
+class TTFBStats:
+    """Recent time-to-first-byte samples per endpoint, for /api/stats."""
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = {}  # kind -> deque of seconds
+
+    def record(self, kind, seconds, label=""):
+        self._samples.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+        logger.info(f"⚡ TTFB {seconds * 1000:.0f} ms ({kind}{' ' + label if label else ''})")
+
+    def stats(self):
+        out = {}
+        for kind, samples in self._samples.items():
+            ordered = sorted(samples)
+            out[kind] = {
+                "requests": len(ordered),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95_ms": round(ordered[int(len(ordered) * 0.95)] * 1000, 1),
+            }
+        return out
+ttfb_stats = TTFBStats()
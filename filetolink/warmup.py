@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import secret
+from database.db import seconds_left
+from filetolink.stream import pyro_client
+from filetolink.fast import TurboStreamer
+from filetolink.media import resolve_media
+from filetolink.container import pin_index
+from filetolink.scheduler import fetch_priority
+logger = logging.getLogger(__name__)
+_tasks = {}  # hash_id -> warm-up task
+def schedule_warmup(hash_id, link):
+    """
+    Start warming a freshly created link in the background: open the DC's
+    media session, pull the first and last WARMUP_CHUNKS chunks into the
+    stream cache and pin the container index (MP4 moov / MKV Cues) before
+    the user taps the button.
+    """
+    if secret.WARMUP_CHUNKS <= 0 or not pyro_client.is_connected:
+        return
+    cancel_warmup(hash_id)
+    task = _tasks[hash_id] = asyncio.create_task(_warm(hash_id, link))
+    task.add_done_callback(lambda t: _tasks.pop(hash_id, None) if _tasks.get(hash_id) is t else None)
+def cancel_warmup(hash_id=None):
+    """Cancel one link's warm-up, or all of them (e.g. /kill)."""
+    targets = [_tasks.get(hash_id)] if hash_id else list(_tasks.values())
+    for task in targets:
+        if task is not None:
+            task.cancel()
+async def _warm(hash_id, link):
+    try:
+        media = await resolve_media(pyro_client, hash_id, link)
+        if not media or not media.file_size:
+            return
+        streamer = TurboStreamer(pyro_client, media, 0, media.file_size - 1, premium=link.get("premium", False))
+        last = streamer.end_chunk
+        count = secret.WARMUP_CHUNKS
+        head = range(0, min(count, last + 1))
+        tail = range(max(last - count + 1, head.stop), last + 1)
+        await streamer.warm([*head, *tail])
+        await pin_index(pyro_client, media, seconds_left(link), fetch_priority("dl", False, link.get("premium", False)))
+        logger.info(f"🔥 Link {hash_id} warmed ({len(head) + len(tail)} chunks)")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"Warm-up of link {hash_id} failed: {e}")
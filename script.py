@@ -18,6 +18,9 @@ import secret
 from database.db import db
 import admin
 from filetolink import timer
+from filetolink.media import describe_media
+from filetolink.links import make_url_id
+from filetolink.warmup import schedule_warmup
 import fsub
 # 🔥 DYNAMIC DOMAIN ENGINE
 DOMAIN = os.getenv("RENDER_EXTERNAL_URL", os.getenv("WEB_URL", "https://new-repo-sere.onrender.com")).rstrip('/')
@@ -514,7 +517,22 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
        
         chat_id = query.message.chat.id
         message_id = query.message.message_id
-        await db.save_link(file_hash, chat_id, message_id, file_name, size, expires_at)
+        # 🎞️ Store the stream descriptor so the web server never has to look the message up
+        media_doc = describe_media(media)
+        if secret.HELPER_BOT_TOKENS and secret.STREAM_CHANNEL_ID:
+            # 🤝 Mirror into the stream channel so helper bots can fetch it too
+            try:
+                mirrored = await context.bot.copy_message(chat_id=secret.STREAM_CHANNEL_ID, from_chat_id=chat_id, message_id=message_id, disable_notification=True)
+                media_doc["mirror"] = {"chat_id": secret.STREAM_CHANNEL_ID, "message_id": mirrored.message_id}
+            except Exception as e:
+                logging.warning(f"Stream mirror failed: {e}")
+        owner_id = query.from_user.id
+        premium = await db.check_premium_status(owner_id)
+        await db.save_link(file_hash, chat_id, message_id, file_name, size, expires_at, media=media_doc, owner_id=owner_id, premium=premium)
+        # 🔥 Warm the link in the background so the first tap streams instantly
+        schedule_warmup(file_hash, {"_id": file_hash, "chat_id": chat_id, "message_id": message_id, "media": media_doc, "premium": premium, "expires_at": expires_at})
+        # 🔏 Signed token when LINK_SIGNING_KEY is set (the saved doc stays as the audit record)
+        url_id = make_url_id(file_hash, chat_id, message_id, getattr(media, 'file_size', 0) or 0, expires_at)
        
         link_text = (
             f"<b><u><blockquote>The Updated Renamer 😎</blockquote></u></b>\n\n"
@@ -528,7 +546,7 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         title = get_title_from_caption(query.message.caption)
         await query.edit_message_reply_markup(reply_markup=get_media_markup(title, is_generated=True))
        
-        await safe_reply(query.message, text=link_text, parse_mode=ParseMode.HTML, reply_markup=get_url_markup(file_hash), disable_web_page_preview=True, message_effect_id=random.choice(secret.MESSAGE_EFFECTS))
+        await safe_reply(query.message, text=link_text, parse_mode=ParseMode.HTML, reply_markup=get_url_markup(url_id), disable_web_page_preview=True, message_effect_id=random.choice(secret.MESSAGE_EFFECTS))
     elif data == "help_menu":
         try: await query.edit_message_media(media=InputMediaPhoto(media=img, caption=HELP_TEXT, parse_mode=ParseMode.HTML), reply_markup=get_help_menu_markup())
         except BadRequest: pass
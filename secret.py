@@ -20,6 +20,56 @@ FSUB_CHANNEL_LINK = os.getenv("FSUB_CHANNEL_LINK", "https://t.me/THEUPDATEDGUYS"
 
 WORKERS = int(os.getenv("WORKERS", "10")) 
 
+# 🎞️ STREAMING ENGINE TUNING
+CHUNK_CACHE_MB = int(os.getenv("CHUNK_CACHE_MB", "64")) # Shared RAM chunk cache (0 = off)
+PIN_CACHE_MB = int(os.getenv("PIN_CACHE_MB", "64")) # RAM for pinned container indexes (MP4 moov / MKV Cues)
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", "") # e.g. /tmp/titanium_cache (empty = off)
+DISK_CACHE_MB = int(os.getenv("DISK_CACHE_MB", "4096"))
+DISK_CACHE_HOURS = int(os.getenv("DISK_CACHE_HOURS", "24"))
+MEDIA_SESSIONS_PER_DC = int(os.getenv("MEDIA_SESSIONS_PER_DC", "3")) # Parallel MTProto media connections per DC
+PREWARM_DCS = [int(dc) for dc in os.getenv("PREWARM_DCS", "").split(",") if dc.strip()] # Extra DCs to warm at boot, e.g. "1,4,5"
+STREAM_BUDGET_MB = int(os.getenv("STREAM_BUDGET_MB", "64")) # Max RAM held by all stream buffers together
+STREAM_MAX_WORKERS = int(os.getenv("STREAM_MAX_WORKERS", "4"))
+DL_MAX_WORKERS = int(os.getenv("DL_MAX_WORKERS", "8"))
+STREAM_TARGET_MBPS = int(os.getenv("STREAM_TARGET_MBPS", "16")) # Per-stream speed we scale workers towards (MB/s)
+STREAM_READAHEAD_SECONDS = int(os.getenv("STREAM_READAHEAD_SECONDS", "20")) # /stream read-ahead in seconds of media
+STREAM_READAHEAD_MB = int(os.getenv("STREAM_READAHEAD_MB", "4")) # ...capped at this many MB
+DL_READAHEAD_MB = int(os.getenv("DL_READAHEAD_MB", "16")) # /dl read-ahead depth
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "2048")) # In-process link lookups kept in RAM
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", "300"))
+LINK_NEGATIVE_TTL = int(os.getenv("LINK_NEGATIVE_TTL", "30")) # How long an unknown hash stays "not found"
+# 🔏 Signed link tokens: set a long random secret to issue stateless links
+# (checked in memory; Mongo keeps the audit record). Empty = classic hashes.
+LINK_SIGNING_KEY = os.getenv("LINK_SIGNING_KEY", "")
+# 🤝 Helper bots for streaming: comma-separated tokens. Each helper must be an
+# admin of STREAM_CHANNEL_ID, where files are mirrored at link creation
+# (file ids are bot-specific, so helpers can't read users' private chats).
+HELPER_BOT_TOKENS = [t.strip() for t in os.getenv("HELPER_BOT_TOKENS", "").split(",") if t.strip()]
+STREAM_CHANNEL_STR = os.getenv("STREAM_CHANNEL_ID", "")
+try: STREAM_CHANNEL_ID = int(STREAM_CHANNEL_STR)
+except ValueError: STREAM_CHANNEL_ID = None
+PRIMARY_MAX_FETCHES = int(os.getenv("PRIMARY_MAX_FETCHES", "2")) # Fetches the bot's own client takes while helpers are up
+FETCH_RATE_MAX = float(os.getenv("FETCH_RATE_MAX", "40")) # GetFile calls/s across the web tier (learned down on FloodWait)
+FETCH_RATE_MIN = float(os.getenv("FETCH_RATE_MIN", "2"))
+HEDGE_MAX_PERCENT = float(os.getenv("HEDGE_MAX_PERCENT", "5")) # Duplicate fetches for stalled chunks, as % of all fetches (0 = off)
+HEDGE_MIN_MS = int(os.getenv("HEDGE_MIN_MS", "300")) # Never hedge before this, even if p95 is lower
+SLOW_START_KB = int(os.getenv("SLOW_START_KB", "64")) # First fetch of an uncached range, doubling to 1 MB (0 = off)
+WARMUP_CHUNKS = int(os.getenv("WARMUP_CHUNKS", "1")) # Chunks pre-fetched from each end of a new link (0 = off)
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "4")) # Fragments are merged into HLS segments of at least this long
+EGRESS_LIMIT_MBPS = float(os.getenv("EGRESS_LIMIT_MBPS", "0")) # Global upload ceiling in Mbit/s, shared fairly by all viewers (0 = off)
+PREMIUM_WEIGHT = float(os.getenv("PREMIUM_WEIGHT", "4")) # A premium owner's links get this many free-link shares of a saturated uplink
+FREE_CONN_MBPS = float(os.getenv("FREE_CONN_MBPS", "0")) # Per-connection cap in Mbit/s for free links (0 = none)
+PREMIUM_CONN_MBPS = float(os.getenv("PREMIUM_CONN_MBPS", "0")) # Per-connection cap in Mbit/s for premium links (0 = none)
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "48")) # Concurrent /stream, /dl and /remux bodies the instance serves
+MAX_STREAMS_PER_IP = int(os.getenv("MAX_STREAMS_PER_IP", "8")) # Per viewer: an IDM / aria2 swarm beyond this waits or gets a 503
+MAX_STREAMS_PER_LINK = int(os.getenv("MAX_STREAMS_PER_LINK", "16")) # Per link, across all viewers
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "32")) # Connections allowed to wait for a slot before 503s start
+ADMISSION_WAIT_SECONDS = float(os.getenv("ADMISSION_WAIT_SECONDS", "5")) # Longest a queued connection waits for a slot
+WRITE_TIMEOUT_SECONDS = float(os.getenv("WRITE_TIMEOUT_SECONDS", "60")) # A client that takes longer than this to accept one write is dropped (0 = off)
+STALL_SECONDS = int(os.getenv("STALL_SECONDS", "120")) # Reaper closes streams that wrote nothing for this long (0 = off)
+MIN_CLIENT_KBPS = int(os.getenv("MIN_CLIENT_KBPS", "32")) # Reaper closes clients draining slower than this (0 = off)
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "1")) # Proxies in front of the app that append to X-Forwarded-For (Render / Heroku: 1, none: 0)
+
 WEB_URL = "https://new-repo-sere.onrender.com"
 
 EMOJIS = ["👍", "❤️", "🔥", "🥰", "👏", "🎉", "🤩", "🙏", "👌", "💯", "⚡", "🏆", "🤝", "🫡", "👨‍💻", "👀", "🐳"]